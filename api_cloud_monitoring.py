@@ -7,6 +7,8 @@ from flask import Flask, request, Response, jsonify, make_response, abort
 
 from api_config import log_config, main_config
 from libs.cloud_wrapper import CloudWrapper
+from libs.db_mongo import init_app as init_mongo, mongo_pool_stats
+from libs.response_cache import get_response_cache
 from libs.tools import convert_anything_to_bool, config_fallback
 
 logging.config.dictConfig(log_config)
@@ -17,6 +19,7 @@ logger.info("Setting the system timezone to {}".format(TZ))
 os.environ['TZ'] = TZ
 
 app = Flask(__name__)
+init_mongo(app)
 executor = ThreadPoolExecutor(1)
 
 global TEST_MODE
@@ -42,6 +45,33 @@ def make_low_utilization(tag_key=None, tag_value=None, max_cpu=None, max_availia
         logger.error("make_low_utilization finish with error")
 
 
+def cached_json_response(endpoint, build):
+    """
+    Serialize build(cloud) only once per (latest report, endpoint, query parameters), and answer 304 Not Modified
+    when the client already has it (If-None-Match with the ETag of the body).
+    """
+    cloud = CloudWrapper('aws')
+    report_id = cloud.get_latest_report_id_from_db()
+    cache = get_response_cache()
+    key = cache.make_key(report_id, endpoint, request.args.items(multi=True))
+    entry = cache.get(key) if report_id is not None else None
+    if entry is None:
+        obj = build(cloud)
+        if obj is None:
+            abort(404)
+        body = dumps(obj)
+        entry = (body, cache.make_etag(body))
+        if report_id is not None:
+            cache.set(key, *entry)
+    body, etag = entry
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, status=200, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
 @app.errorhandler(404)
 def not_found(error):
     return make_response(jsonify({'error': 'Notfound'}), 404)
@@ -63,13 +93,35 @@ def run_low_utilization():
     tag_key = request.args.get('tag_key')
     tag_value = request.args.get('tag_value')
     summary_report = convert_anything_to_bool(request.args.get('summary'))
-    cloud = CloudWrapper('aws')
-    obj = cloud.get_low_utilization_from_db(tag_key=tag_key, tag_value=tag_value, summary_report=summary_report)
-    if obj is None:
-        abort(404)
-    obj_formatted = dumps(obj)
-    response = Response(obj_formatted, status=200, mimetype='application/json')
-    return response
+    # Many tags as tag=key:value, all the keys must match, a repeated key matches any of its values and value*
+    # matches by prefix.
+    tags = {}
+    for tag in request.args.getlist('tag'):
+        if ':' in tag:
+            tag_key_value = tag.split(':', 1)
+            tags.setdefault(tag_key_value[0], []).append(tag_key_value[1])
+    limit = request.args.get('limit', type=int)
+    return cached_json_response('lowutilization', lambda cloud: cloud.get_low_utilization_from_db(
+        tag_key=tag_key, tag_value=tag_value, summary_report=summary_report, tags=tags, limit=limit))
+
+
+@app.route('/api/v1.0/lowutilization/history', methods=['GET'])
+def run_low_utilization_history():
+    since = request.args.get('since')
+    limit = request.args.get('limit', type=int)
+    details = convert_anything_to_bool(request.args.get('details'))
+    return cached_json_response('history', lambda cloud: cloud.get_summary_history_from_db(since=since, limit=limit,
+                                                                                           details=details))
+
+
+@app.route('/api/v1.0/status/mongo', methods=['GET'])
+def mongo_status():
+    return make_response(jsonify(mongo_pool_stats()), 200)
+
+
+@app.route('/api/v1.0/status/cache', methods=['GET'])
+def response_cache_status():
+    return make_response(jsonify(get_response_cache().stats()), 200)
 
 
 if __name__ == '__main__':
@@ -2,18 +2,33 @@ main_config = {
     "api_listner_ip": "0.0.0.0",
     "api_listner_port": "8080",
     "api_flash_debug": True,
+    "api_response_cache_max_bytes": 268435456,  # serialized responses kept in memory (LRU)
+    "api_response_cache_max_entries": 128,
 
     "criteria_percent_max_cpu": 50,
     "criteria_max_mem_available_pct": 50,
     "criteria_network_io_mega": 150,  # 1GB
     "criteria_aggregation_value": 14,
     "criteria_aggegation_unit": 'days',
+    "criteria_aggregation_windows": [1, 7, 14, 30],  # extra windows in the same unit, from one fetch of the longest
+    "criteria_percent_p95_cpu": None,  # e.g. 70, None to not use the p95 of CPU
+    "criteria_idle_cpu_percent": 5,  # hours with CPU below it are idle hours
 
     "system_timezone": "UTC",
     "system_ssh_timeout": 4,
+    "system_ssh_workers": 200,  # hosts probed through SSH at the same time
+    "system_ssh_host_deadline": 15,  # seconds to probe one host, for all usernames
+    "system_ssh_overall_deadline": 600,  # seconds to probe all hosts of a scan
+    "system_ssh_credential_cache_file": "ssh_credential_cache.json",
+    "system_ssh_negative_ttl": 21600,  # seconds to skip hosts and keys known to fail
     "system_ntp_server": "0.north-america.pool.ntp.org, 1.north-america.pool.ntp.org, 2.north-america.pool.ntp.org, 3.north-america.pool.ntp.org",
     "system_loglevel": "DEBUG",
     "system_logfile": None,
+    "system_scan_workers": 16,  # 1 = process the instances one by one
+    "system_scan_limits": {"region": 8, "ec2": 4, "pricing": 2},  # max concurrent workers per region
+    "system_incremental_scan": False,  # carry forward the details of the instances unchanged since the last scan
+    "system_scan_snapshot_file": "scan_snapshot.json",
+    "system_scan_snapshot_max_age": 604800,  # seconds before an unchanged instance is processed from scratch again
     "system_test_mode_ids": [
         {'id': 'i-0aeb5dcc19892e8a6', 'region': 'us-east-1'},
         {'id': 'i-0f6cf1cb60ec1e35a', 'region': 'sa-east-1'},  # Não temos a chave mas é low utilization no report
@@ -27,13 +42,40 @@ main_config = {
 
     # "aws_regions": ['us-east-1','us-west-1','us-west-2','eu-west-1','sa-east-1', 'ap-southeast-1','ap-southeast-2','ap-northeast-1'],
     "aws_regions": ['sa-east-1', 'us-east-1'],
+    "aws_max_pool_connections": 50,  # HTTP connections kept per boto3 client
+    "aws_tcp_keepalive": True,
+    "aws_rate_limits": {"default": 10, "cloudwatch": 20, "ec2": 20, "autoscaling": 10, "pricing": 5},  # req/s
+    "aws_max_retries": 5,  # only throttling and transient errors are retried
+    "aws_retry_base_delay": 0.5,  # seconds
+    "aws_retry_max_delay": 20,  # seconds
+    "aws_region_discovery_timeout": 300,  # seconds to wait for the listing of all regions
     "aws_ssh_key_folder": "/Volumes/DataDisk/csmaniotto/projects/pemkeys/",
     "aws_tag_exclude": ['elasticbeanstalk:', 'aws:', 'k8s.'],
+    "aws_cloudwatch_max_queries": 500,  # GetMetricData limit of queries per call
+    "aws_cwagent_namespace": "CWAgent",  # memory from the CloudWatch Agent, SSH is the fallback
+    "aws_cwagent_memory_metric": "mem_available_percent",
+    "aws_metrics_store_dir": "metrics_store",  # local store of the CloudWatch datapoints, None to disable it
+    "aws_metrics_store_retention": 35,  # days, at least the longest of criteria_aggregation_windows
+    "aws_metrics_store_max_segments": 8,  # segments of a region before compacting them
+    "aws_price_cache_file": "price_cache.json",
+    "aws_price_cache_ttl": 86400,  # seconds
 
     # "mongo-server": "localhost:32768",
     "mongo-server": "abc833672e4d711e7996102ed2455e02-33316868.sa-east-1.elb.amazonaws.com:27017",
     "mongo_db-": "clound_mon",
-    "mongo_collection": "low_utilization"
+    "mongo_collection": "low_utilization",
+    "mongo_insert_batch_size": 1000,  # instance documents per insert_many
+    "mongo_index_tags": ['team', 'owner', 'work'],  # tags indexed in the instance documents
+    "mongo_max_pool_size": 50,  # connections of the process-wide MongoClient
+    "mongo_min_pool_size": 2,
+    "mongo_max_idle_time_ms": 300000,
+    "mongo_connect_timeout_ms": 5000,
+    "mongo_socket_timeout_ms": 60000,
+    "mongo_server_selection_timeout_ms": 5000,
+    "mongo_wait_queue_timeout_ms": 5000,  # wait for a free connection of the pool
+    "mongo_read_preference": "primaryPreferred",
+    "mongo_query_limit": 1000,  # max instances returned by the tag queries
+    "mongo_history_limit": 90,  # max summaries returned by the history endpoint
 }
 
 log_config = {
@@ -77,6 +119,66 @@ log_config = {
             'level': 'DEBUG',
             'propagate': False,
         },
+
+        'db_mongo': {  # logging from this module will be logged in VERBOSE level
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+
+        'aws_clients': {  # logging from this module will be logged in VERBOSE level
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+
+        'price_cache': {  # logging from this module will be logged in VERBOSE level
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+
+        'ssh_probe': {  # logging from this module will be logged in VERBOSE level
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+
+        'metrics_matrix': {  # logging from this module will be logged in VERBOSE level
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+
+        'metrics_store': {  # logging from this module will be logged in VERBOSE level
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+
+        'scan_snapshot': {  # logging from this module will be logged in VERBOSE level
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+
+        'report_accumulator': {  # logging from this module will be logged in VERBOSE level
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+
+        'report_summary': {  # logging from this module will be logged in VERBOSE level
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+
+        'response_cache': {  # logging from this module will be logged in VERBOSE level
+            'handlers': ['default'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
     },
     'root': {
         'level': 'INFO',
@@ -0,0 +1,211 @@
+import logging
+import logging.config
+import random
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectionClosedError, ReadTimeoutError, \
+    ConnectTimeoutError
+
+from api_config import log_config, main_config
+from libs.tools import config_fallback
+
+logging.config.dictConfig(log_config)
+logger = logging.getLogger("aws_clients")
+
+THROTTLING_ERROR_CODES = ['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                          'RequestThrottled', 'RequestLimitExceeded', 'TooManyRequestsException',
+                          'ProvisionedThroughputExceededException', 'SlowDown', 'BandwidthLimitExceeded']
+TRANSIENT_ERROR_CODES = ['InternalError', 'InternalFailure', 'InternalServiceError', 'ServiceUnavailable',
+                         'ServiceUnavailableException', 'RequestTimeout', 'RequestTimeoutException']
+TRANSIENT_EXCEPTIONS = (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError, ConnectTimeoutError)
+
+
+def aws_error_code(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code')
+    return None
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Token bucket of one (service, region). The rate is cut by half on each throttling error and grows
+    back slowly on success, until max_rate, so the scan stays close to what AWS accepts.
+    """
+    decrease_factor = 0.5
+    increase_step = 0.1
+
+    def __init__(self, max_rate, min_rate=0.5):
+        self.max_rate = float(max_rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.rate = self.max_rate
+        self.tokens = self.max_rate
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.tokens = min(self.tokens, 0)
+
+
+class AWSClientRegistry(object):
+    """
+        AWSClientRegistry class.
+        Keep one boto3 client per (service, region) for the whole process, all of them built with the same
+        botocore config, so the scans reuse warm HTTP connection pools instead of rebuilding clients.
+    """
+
+    def __init__(self, max_pool_connections=None, tcp_keepalive=None):
+        self.max_pool_connections = int(config_fallback(
+            max_pool_connections, fallback=config_fallback(main_config['aws_max_pool_connections'], fallback=50)))
+        self.tcp_keepalive = config_fallback(tcp_keepalive,
+                                             fallback=config_fallback(main_config['aws_tcp_keepalive'], fallback=True))
+        self.rate_limits = config_fallback(main_config['aws_rate_limits'], fallback={})
+        self.max_retries = int(config_fallback(main_config['aws_max_retries'], fallback=5))
+        self.retry_base_delay = float(config_fallback(main_config['aws_retry_base_delay'], fallback=0.5))
+        self.retry_max_delay = float(config_fallback(main_config['aws_retry_max_delay'], fallback=20))
+        self.session = boto3.Session()
+        self.config = self.__build_config()
+        self.clients = {}
+        self.rate_limiters = {}
+        self.counters = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        logger.debug("AWS client registry has been created with max_pool_connections={}".format(
+            self.max_pool_connections))
+
+    def __build_config(self):
+        # The retries are done by call(), so botocore must not retry (and hide) the throttling errors.
+        kword = {'max_pool_connections': self.max_pool_connections, 'retries': {'max_attempts': 0}}
+        if self.tcp_keepalive:
+            try:
+                return Config(tcp_keepalive=True, **kword)
+            except TypeError:
+                # botocore releases older than 1.27 do not know the tcp_keepalive option.
+                logger.warning("botocore without tcp_keepalive support, using only the connection pool")
+        return Config(**kword)
+
+    def client(self, service, region):
+        key = (service, region)
+        client = self.clients.get(key)
+        if client is None:
+            # boto3 sessions are not thread safe, the clients created by them are.
+            with self.lock:
+                client = self.clients.get(key)
+                if client is None:
+                    client = self.session.client(service, region_name=region, config=self.config)
+                    self.clients[key] = client
+                    logger.debug("New AWS client {} for region {}".format(service, region))
+        return client
+
+    def resource(self, service, region):
+        # boto3 resources are not thread safe, so they are kept per thread.
+        resources = getattr(self.local, 'resources', None)
+        if resources is None:
+            resources = self.local.resources = {}
+        key = (service, region)
+        if key not in resources:
+            with self.lock:
+                resources[key] = self.session.resource(service, region_name=region, config=self.config)
+        return resources[key]
+
+    def rate_limiter(self, service, region):
+        key = (service, region)
+        limiter = self.rate_limiters.get(key)
+        if limiter is None:
+            with self.lock:
+                limiter = self.rate_limiters.get(key)
+                if limiter is None:
+                    max_rate = config_fallback(self.rate_limits.get(service),
+                                               fallback=self.rate_limits.get('default', 10))
+                    limiter = AdaptiveRateLimiter(max_rate)
+                    self.rate_limiters[key] = limiter
+                    self.counters[key] = {'calls': 0, 'throttles': 0, 'retries': 0, 'failures': 0}
+        return limiter
+
+    def __count(self, service, region, counter):
+        with self.lock:
+            self.counters[(service, region)][counter] += 1
+
+    def call(self, service, region, operation, **kwargs):
+        """
+        Call the operation of the (service, region) client through its rate limiter.
+        Only throttling and transient errors are retried, with full jitter exponential backoff.
+        """
+        client = self.client(service, region)
+        limiter = self.rate_limiter(service, region)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            self.__count(service, region, 'calls')
+            try:
+                result = getattr(client, operation)(**kwargs)
+                limiter.on_success()
+                return result
+            except (ClientError,) + TRANSIENT_EXCEPTIONS as e:
+                code = aws_error_code(e)
+                if code in THROTTLING_ERROR_CODES:
+                    limiter.on_throttle()
+                    self.__count(service, region, 'throttles')
+                retryable = code in THROTTLING_ERROR_CODES or code in TRANSIENT_ERROR_CODES or isinstance(
+                    e, TRANSIENT_EXCEPTIONS)
+                if not retryable or attempt >= self.max_retries:
+                    self.__count(service, region, 'failures')
+                    raise
+                attempt += 1
+                self.__count(service, region, 'retries')
+                delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * (2 ** attempt)))
+                logger.warning("{} on {}.{} of region {}, retry {} in {:.2f} seconds...".format(
+                    code or e, service, operation, region, attempt, delay))
+                time.sleep(delay)
+
+    def paginate(self, service, region, operation, **kwargs):
+        """
+        Generator over the pages of an operation paginated by NextToken, every page goes through call().
+        """
+        while True:
+            page = self.call(service, region, operation, **kwargs)
+            yield page
+            if not page.get('NextToken'):
+                break
+            kwargs['NextToken'] = page['NextToken']
+
+    def stats(self):
+        with self.lock:
+            return dict(("{}:{}".format(service, region), dict(counters))
+                        for (service, region), counters in self.counters.items())
+
+
+client_registry = None
+client_registry_lock = threading.Lock()
+
+
+def get_client_registry():
+    """
+    Return the process-wide AWSClientRegistry, so the boto3 clients, their connection pools and the rate limiters
+    are created once and shared by all scans.
+    """
+    global client_registry
+    with client_registry_lock:
+        if client_registry is None:
+            client_registry = AWSClientRegistry()
+        return client_registry
@@ -1,22 +1,69 @@
 import json
 import logging
 import logging.config
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
 from datetime import timedelta
 
-import boto3
+import numpy as np
 import pandas as pd
 
 from api_config import log_config, main_config
-from libs.tools import datetime_iso8601, convert_dict_dataframe, ssh_os_linux_available_memory, \
-    check_is_file_exist, df_to_picke, picke_to_dataframe, nan2floatzero, check_string_in_list, config_fallback, \
-    count_tags, convert_anything_to_bool
+from libs.tools import datetime_iso8601, \
+    check_is_file_exist, df_to_picke, picke_to_dataframe, check_string_in_list, config_fallback, \
+    convert_anything_to_bool, ConcurrencyLimiter, default_mem_info, get_timestp, round_or_none, df_to_records
+from libs.aws_clients import get_client_registry
+from libs.metrics_matrix import MetricsMatrix, epoch
+from libs.metrics_store import get_metrics_store, select_rows, make_columns, concat_columns, instances_codes
+from libs.price_cache import get_price_cache
+from libs.report_accumulator import ReportAccumulator
+from libs.report_summary import summarize_instances
+from libs.scan_snapshot import get_scan_snapshot, instance_fingerprint
+from libs.ssh_probe import ssh_memory_probe_batch
 
 # import datetime
 
 logging.config.dictConfig(log_config)
 logger = logging.getLogger("aws_interface")
 
+EC2_METRICS = ['CPUUtilization', 'DiskReadOps', 'DiskWriteOps', 'NetworkIn', 'NetworkOut']
+AGENT_MEMORY_METRIC = 'MemAvailablePercent'
+
+# MemoryProbeStatus values of the report, plus the PROBE_* outcomes of ssh_probe for the instances probed
+MEMORY_NOT_PROBED = 'not probed'
+MEMORY_NO_ACCESS = 'no ip or ssh key'
+MEMORY_CARRIED = 'carried forward'
+
+# MemorySource values of the report, who produced the AvailiableMemoryPerc
+MEMORY_SOURCE_AGENT = 'cloudwatch agent'
+MEMORY_SOURCE_SSH = 'ssh'
+MEMORY_SOURCE_NONE = 'none'
+
+# MetricsStatus values of the report, the metrics are None unless they are ok
+METRICS_OK = 'ok'
+METRICS_NO_DATA = 'no data'
+METRICS_FAILED = 'fetch failed'
+
+# Reserved without up front
+RESERVED_OFFER_TERM = '4NA7Y494T4'
+RESERVED_OFFER_TERMS = {
+    'BPH4J8HBKS': '3yr standard No Upfront',
+    'NQ3QZPMQV9': '3yr standard All Upfront',
+    'HU7G6KETJZ': '1yr standard Partial Upfront',
+    '6QCMYABX3D': '1yr standard All Upfront',
+    'R5XV2EPZQZ': '3yr convertible Partial Upfront',
+    'VJWZNREJX2': '1yr convertible All Upfront',
+    'MZU6U2429S': '3yr convertible All Upfront',
+    '38NPMPTW36': '3yr standard Partial Upfront',
+    '7NE97W5U4E': '1yr convertible No Upfront',
+    'CUZHX8X6JH': '1yr convertible Partial Upfront',
+    'Z2E3P23VKM': '3yr convertible No Upfront',
+    '4NA7Y494T4': '1yr standard No Upfront'
+}
+
 
 class AWSInterface(object):
     """
@@ -28,37 +75,61 @@ class AWSInterface(object):
     # logger = log
 
     aws_connection = None
+    aws_clients = None
     ec2_connection = None
     asg_connection = None
 
     aws_regions = None
     aws_regions = None
 
+    instances_inventory = None
+    reserved_index = None
+    reserved_assignments = None
+    asg_index = None
+    limiter = None
+
     def __init__(self, test_mode=False):
         self.test_mode = test_mode
         logger.warning('AWS INTERFACE INITIALIZED')
         self.aws_regions = main_config["aws_regions"]
         self.aws_connection = None
+        self.instances_inventory = {}
+        self.reserved_index = {}
+        self.reserved_assignments = {}
+        self.asg_index = {}
+        self.scan_details = {}
+        self.lock = threading.RLock()
+        self.limiter = ConcurrencyLimiter(config_fallback(main_config['system_scan_limits'], fallback={}))
         try:
-            self.aws_connection = boto3.Session()
+            self.aws_clients = get_client_registry()
+            self.aws_connection = self.aws_clients.session
             logger.debug("AWS Session has been created with success...")
         except Exception as e:
             logger.error("Error to access AWS API {}".format(e))
 
-    def __check_instance_in_asg(self, instance_id, instance_region):
+    def __load_asg_instances(self, instance_region):
+        """
+        Build the instance_id -> AutoScalingGroupName map of the whole region with paginated bulk calls.
+        """
+        asg_instances = {}
         try:
-            asg_connection = self.aws_connection.client('autoscaling', region_name=instance_region)
-            instances = asg_connection.describe_auto_scaling_instances(InstanceIds=[instance_id])
-            instance_status = instances['AutoScalingInstances']
-            if instance_status:
-                asgname = instances['AutoScalingInstances'][0]['AutoScalingGroupName']
-                logger.debug(
-                    "Instance %s is in autoscale group {}".format(instance_id,
-                                                                  instance_status[0]['AutoScalingGroupName']))
-                return True, asgname
-            return False, None
+            for page in self.aws_clients.paginate('autoscaling', instance_region, 'describe_auto_scaling_instances'):
+                for asg_instance in page['AutoScalingInstances']:
+                    asg_instances[asg_instance['InstanceId']] = asg_instance['AutoScalingGroupName']
+            logger.debug("Loaded {} ASG instances of region {}".format(len(asg_instances), instance_region))
         except Exception:
-            logger.error("Error on get ASG information")
+            logger.error("Error on get ASG information of region {}".format(instance_region))
+        self.asg_index[instance_region] = asg_instances
+
+    def __check_instance_in_asg(self, instance_id, instance_region):
+        with self.lock:
+            if instance_region not in self.asg_index:
+                self.__load_asg_instances(instance_region)
+        asgname = self.asg_index[instance_region].get(instance_id)
+        if asgname is not None:
+            logger.debug("Instance {} is in autoscale group {}".format(instance_id, asgname))
+            return True, asgname
+        return False, None
 
     def __aws_region_convert(self, instance_region):
 
@@ -86,144 +157,517 @@ class AWSInterface(object):
             logger.exception(msg="error on get region full name", exc_info=True)
             exit(1)
 
-    def __avg_cloudwatch_metrics(self, clouldwatchstats):
-        try:
-            average = 0
-            datapoints = clouldwatchstats['Datapoints']
-            if len(datapoints) > 0:
-                sum = 0
-                for n in datapoints:
-                    sum = sum + n['Average']
-                average = sum / len(datapoints)
-                return average
-            else:
-                return 0
-        except Exception as e:
-            logger.debug("Error function parseavarage {}".format(e))
+    def __get_aggregation_window(self, aggregation_type='days', aggregation=14):
+        if 'minutes' in aggregation_type:
+            starttime = datetime.today() - timedelta(minutes=int(aggregation))
+        else:
+            starttime = datetime.today() - timedelta(days=int(aggregation))
+        endtime = datetime.today()
+        return starttime, endtime
+
+    @staticmethod
+    def __aggregation_seconds(aggregation_type='days', aggregation=14):
+        return int(aggregation) * (60 if 'minutes' in aggregation_type else 86400)
+
+    def __get_aggregation_windows(self, aggregation_type='days', aggregation=14):
+        """
+        The windows of criteria_aggregation_windows, in the same unit as the aggregation, all of them computed
+        from a single fetch of the longest one (the aggregation included).
+
+        :return: tuple (longest aggregation, dict {label: seconds}), e.g. (30, {'1d': 86400, '7d': 604800, ...})
+        """
+        unit_label = 'm' if 'minutes' in aggregation_type else 'd'
+        values = [int(value) for value in config_fallback(main_config['criteria_aggregation_windows'], fallback=[])]
+        windows = dict(("{}{}".format(value, unit_label), self.__aggregation_seconds(aggregation_type, value))
+                       for value in values)
+        return max(values + [int(aggregation)]), windows
+
+    def __list_agent_memory_metrics(self, instance_region, agent_namespace, agent_metric_name):
+        """
+        Find with paginated list_metrics calls the dimensions of the CloudWatch Agent memory metric of each instance
+        of the region, the agent may append ImageId, InstanceType and AutoScalingGroupName to the InstanceId.
 
-    def __cloudwatch_ec2(self, instance_id, aws_region, metricname, starttime, endtime, period):
+        :return: dict {instance_id: dimensions}
+        """
+        agent_dimensions = {}
         try:
-            cloudwatch_connection = self.aws_connection.client('cloudwatch', region_name=aws_region)
-            query = {
-                "Namespace": "AWS/EC2",
-                "MetricName": metricname,
-                "Dimensions": [{"Name": "InstanceId", "Value": instance_id}],
-                "StartTime": starttime,
-                "EndTime": endtime,
-                "Period": period,
-                "Statistics": ['Average']
-            }
-            result = cloudwatch_connection.get_metric_statistics(**query)
-            return result
+            for page in self.aws_clients.paginate('cloudwatch', instance_region, 'list_metrics',
+                                                  Namespace=agent_namespace, MetricName=agent_metric_name):
+                for metric in page['Metrics']:
+                    for dimension in metric['Dimensions']:
+                        if dimension['Name'] != 'InstanceId':
+                            continue
+                        # Same instance with many dimension sets, the shorter one is the more generic.
+                        current = agent_dimensions.get(dimension['Value'])
+                        if current is None or len(metric['Dimensions']) < len(current):
+                            agent_dimensions[dimension['Value']] = metric['Dimensions']
+            logger.debug("Found {} instances with {}/{} in region {}".format(len(agent_dimensions), agent_namespace,
+                                                                           agent_metric_name, instance_region))
         except Exception:
-            logger.exception("Error on __cloudwatch_ec2", exc_info=True)
+            logger.exception("Error on __list_agent_memory_metrics of region {}".format(instance_region),
+                             exc_info=True)
+        return agent_dimensions
 
-    def __reserved_instances(self, instance_region, instance_type=None, availability_zone=None, state='active'):
-        reserved = {}
-        try:
-            reserved_connection = self.aws_connection.client('ec2', region_name=instance_region)
-            if instance_type is None:
-                rs = reserved_connection.describe_reserved_instances()
-                return reserved
+    def __get_region_metrics(self, instances_ids, instance_region, starttime, endtime, period=3600,
+                             aggregation_seconds=None, windows=None):
+        """
+        Collect the EC2_METRICS of many instances of the same region, and the CloudWatch Agent memory metric of
+        the instances that publish it, packing the instance/metric queries into batched GetMetricData requests
+        (up to aws_cloudwatch_max_queries per call). With the local MetricsStore, only the tail after the
+        datapoints already stored is fetched.
+        The statistics are computed over the last aggregation_seconds (the whole fetch when None) and, from
+        the same datapoints, over each one of windows {label: seconds}.
+
+        :return: dict of __get_metrics_statistics()
+        """
+        agent_namespace = config_fallback(main_config['aws_cwagent_namespace'], fallback='CWAgent')
+        agent_metric_name = config_fallback(main_config['aws_cwagent_memory_metric'], fallback='mem_available_percent')
+        agent_dimensions = self.__list_agent_memory_metrics(instance_region, agent_namespace, agent_metric_name)
+        matrix = MetricsMatrix(instances_ids, EC2_METRICS + [AGENT_MEMORY_METRIC], starttime, endtime, period)
+
+        # The datapoints already in the local store are not fetched again, only the tail after the newer one, when
+        # the stored ones reach back to starttime. Otherwise (a longer window than the previous scans, or an instance
+        # stored for a shorter time) the whole window is fetched again.
+        store = get_metrics_store()
+        fetch_starts = dict((instance_id, starttime) for instance_id in instances_ids)
+        if store.enabled:
+            stored = store.load(instance_region, instances_ids, since=epoch(starttime))
+            matrix.add_columns(stored['instance_ids'], stored['metric_names'], stored['instances'], stored['metrics'],
+                               stored['timestamps'], stored['values'])
+            for instance_id, (first_timestamp, last_timestamp) in store.timestamps_range(stored).items():
+                if first_timestamp >= epoch(starttime) + period:
+                    continue
+                # The last period may have been incomplete when it was fetched, so it is fetched again.
+                fetch_start = datetime.fromtimestamp(last_timestamp - last_timestamp % period - period)
+                fetch_starts[instance_id] = max(starttime, fetch_start)
+        fetch_groups = {}
+        for instance_id, fetch_start in fetch_starts.items():
+            fetch_groups.setdefault(fetch_start, []).append(instance_id)
+
+        fetched = []
+        failed = set()
+        for fetch_start, group_ids in sorted(fetch_groups.items()):
+            logger.debug("Fetching metrics of {} instances of region {} since {}".format(len(group_ids),
+                                                                                      instance_region, fetch_start))
+            queries, queries_index = self.__build_metric_queries(group_ids, period, agent_dimensions,
+                                                                 agent_namespace, agent_metric_name)
+            failed.update(self.__fetch_metric_queries(queries, queries_index, instance_region, fetch_start, endtime,
+                                                      matrix, fetched))
+
+        # The instances of a failed batch have no metrics at all, not the stored ones nor a part of the fetched.
+        for instance_id in failed:
+            matrix.clear(instance_id)
+        if store.enabled:
+            columns = concat_columns(fetched)
+            store.append(instance_region, select_rows(columns, ~np.isin(columns['instances'],
+                                                                        instances_codes(columns, failed))))
+
+        return self.__get_metrics_statistics(matrix, aggregation_seconds, windows, failed)
+
+    def __build_metric_queries(self, instances_ids, period, agent_dimensions, agent_namespace, agent_metric_name):
+        """
+        :return: tuple (list of GetMetricData queries, dict {query_id: (instance_id, metric_name)})
+        """
+        queries = []
+        queries_index = {}
+        for instance_idx, instance_id in enumerate(instances_ids):
+            if instance_id in agent_dimensions:
+                query_id = "m{}_mem".format(instance_idx)
+                queries_index[query_id] = (instance_id, AGENT_MEMORY_METRIC)
+                queries.append({
+                    "Id": query_id,
+                    "MetricStat": {
+                        "Metric": {
+                            "Namespace": agent_namespace,
+                            "MetricName": agent_metric_name,
+                            "Dimensions": agent_dimensions[instance_id]
+                        },
+                        "Period": period,
+                        "Stat": "Average"
+                    },
+                    "ReturnData": True
+                })
+            for metric_idx, metric_name in enumerate(EC2_METRICS):
+                # The query Id must start with a lowercase letter and be unique in the request.
+                query_id = "m{}_{}".format(instance_idx, metric_idx)
+                queries_index[query_id] = (instance_id, metric_name)
+                queries.append({
+                    "Id": query_id,
+                    "MetricStat": {
+                        "Metric": {
+                            "Namespace": "AWS/EC2",
+                            "MetricName": metric_name,
+                            "Dimensions": [{"Name": "InstanceId", "Value": instance_id}]
+                        },
+                        "Period": period,
+                        "Stat": "Average"
+                    },
+                    "ReturnData": True
+                })
+        return queries, queries_index
+
+    def __fetch_metric_queries(self, queries, queries_index, instance_region, starttime, endtime, matrix, fetched):
+        """
+        Run the queries in batches of aws_cloudwatch_max_queries, adding the datapoints of each batch to the
+        matrix and, as MetricsStore columns coded by the matrix rows and metrics, to the fetched list. The
+        datapoints of a batch are only used when all its pages have been fetched, and a failed batch does not
+        stop the next ones.
 
+        :return: set with the instance ids of the failed batches.
+        """
+        max_queries = int(config_fallback(main_config['aws_cloudwatch_max_queries'], fallback=500))
+        failed = set()
+        for batch_start in range(0, len(queries), max_queries):
+            batch_queries = queries[batch_start:batch_start + max_queries]
+            results = []
+            try:
+                for rs in self.aws_clients.paginate('cloudwatch', instance_region, 'get_metric_data',
+                                                    MetricDataQueries=batch_queries,
+                                                    StartTime=starttime,
+                                                    EndTime=endtime):
+                    results.extend(rs['MetricDataResults'])
+            except Exception:
+                batch_ids = set(queries_index[query['Id']][0] for query in batch_queries)
+                failed.update(batch_ids)
+                logger.exception("Error on GetMetricData batch {}-{} of region {}, {} instances without metrics".format(
+                    batch_start, batch_start + len(batch_queries), instance_region, len(batch_ids)), exc_info=True)
+                continue
+            results_index = [queries_index[result['Id']] for result in results]
+            counts = [len(result['Values']) for result in results]
+            batch = make_columns(
+                matrix.instances_ids, matrix.metric_names,
+                np.repeat([matrix.rows_index[instance_id] for instance_id, _ in results_index], counts),
+                np.repeat([matrix.metric_names.index(metric_name) for _, metric_name in results_index], counts),
+                [int(epoch(timestamp)) for result in results for timestamp in result['Timestamps']],
+                [value for result in results for value in result['Values']])
+            matrix.add_columns(batch['instance_ids'], batch['metric_names'], batch['instances'], batch['metrics'],
+                               batch['timestamps'], batch['values'])
+            fetched.append(batch)
+            logger.debug("GetMetricData batch {}-{} of {} queries collected in {}".format(
+                batch_start, batch_start + len(batch_queries), len(queries), instance_region))
+        return failed
+
+    def __get_metrics_statistics(self, matrix, aggregation_seconds=None, windows=None, failed=None):
+        """
+        Compute, for all instances of the matrix at once, the mean of each metric plus max, p95 and
+        the fraction of idle hours of CPU over the last aggregation_seconds, and the mean, p95 and idle hours
+        of CPU and the mean of network over each one of windows.
+
+        :return: dict {instance_id: {metric_name: average, ..., 'Windows': {label: {metric_name: average, ...}}}},
+            the statistics without datapoints are None and MetricsStatus says why.
+        """
+        failed = failed or set()
+        idle_cpu = config_fallback(main_config['criteria_idle_cpu_percent'], fallback=5)
+        periods = None
+        if aggregation_seconds is not None:
+            periods = int(math.ceil(aggregation_seconds / matrix.period))
+        means = dict((metric_name, matrix.mean(metric_name, periods)) for metric_name in EC2_METRICS)
+        cpu_max = matrix.max('CPUUtilization', periods)
+        cpu_p95 = matrix.percentile('CPUUtilization', 95, periods)
+        cpu_idle = matrix.fraction_below('CPUUtilization', idle_cpu, periods)
+        cpu_has_data = matrix.has_data('CPUUtilization', periods)
+        agent_memory = matrix.mean(AGENT_MEMORY_METRIC, periods)
+        agent_has_data = matrix.has_data(AGENT_MEMORY_METRIC, periods)
+
+        windows_stats = {}
+        for label, seconds in (windows or {}).items():
+            window_periods = int(math.ceil(seconds / matrix.period))
+            windows_stats[label] = {
+                'CPUUtilization': matrix.mean('CPUUtilization', window_periods),
+                'CPUUtilization_p95': matrix.percentile('CPUUtilization', 95, window_periods),
+                'CPUIdleHours': matrix.fraction_below('CPUUtilization', idle_cpu, window_periods),
+                'NetworkIn': matrix.mean('NetworkIn', window_periods),
+                'NetworkOut': matrix.mean('NetworkOut', window_periods),
+            }
+
+        metrics = {}
+        for row, instance_id in enumerate(matrix.instances_ids):
+            metrics[instance_id] = dict((metric_name, round_or_none(means[metric_name][row], 6))
+                                        for metric_name in EC2_METRICS)
+            metrics[instance_id][AGENT_MEMORY_METRIC] = float(agent_memory[row]) if agent_has_data[row] else None
+            metrics[instance_id]['CPUUtilization_max'] = round_or_none(cpu_max[row], 6)
+            metrics[instance_id]['CPUUtilization_p95'] = round_or_none(cpu_p95[row], 6)
+            metrics[instance_id]['CPUIdleHours'] = round_or_none(cpu_idle[row], 6)
+            metrics[instance_id]['Windows'] = dict(
+                (label, dict((stat, round_or_none(values[row], 6)) for stat, values in window_stats.items()))
+                for label, window_stats in windows_stats.items())
+            if instance_id in failed:
+                metrics[instance_id]['MetricsStatus'] = METRICS_FAILED
+            elif cpu_has_data[row]:
+                metrics[instance_id]['MetricsStatus'] = METRICS_OK
             else:
-                rs = reserved_connection.describe_reserved_instances(Filters=[
-                    {'Name': 'instance-type',
-                     'Values': [instance_type]
-                     },
-                    # {'Name': 'availability-zone',
-                    #  'Values': [availability_zone]
-                    # },
-                    {'Name': 'state',
-                     'Values': [state]
-                     }])
-
-                if 'ReservedInstances' in rs.keys():
-                    if len(rs['ReservedInstances']) > 0:
-                        reserved['scope'] = rs['ReservedInstances'][0]['Scope']
-                        reserved['reservedprice'] = rs['ReservedInstances'][0]['UsagePrice']
-                        reserved['offeringclass'] = rs['ReservedInstances'][0]['OfferingClass']
-                        if 'Region' in rs['ReservedInstances'][0]['Scope']:
-                            reserved['availabilityzone'] = instance_region
-                        else:
-                            reserved['availabilityzone'] = rs['ReservedInstances'][0]['AvailabilityZone']
-                        reserved['reservedinstancesid'] = rs['ReservedInstances'][0]['ReservedInstancesId']
-                return reserved
-        except Exception as e:
-            logger.error("Error on get reserved information: {}".format(e))
-
-    def __get_instance_ssh_memory_info(self, instance_ip, instance_ssh_key, instance_id, instance_region):
-        # Try to get in the instance, the memory available.
-        dict_mem_info = dict()
-        dict_mem_info['memtotal'] = -1
-        dict_mem_info['memavailable'] = -1
-        dict_mem_info['percent_free'] = -1
-        dict_mem_info['kernel'] = 'unknown'
-        dict_mem_info['distro'] = 'unknown'
+                metrics[instance_id]['MetricsStatus'] = METRICS_NO_DATA
+        return metrics
+
+    def __load_reserved_instances(self, instance_region, state='active'):
+        """
+        Load all reservations of the region once into an index keyed by (instance_type, zone, scope).
+        Zonal reservations use the availability zone as zone and regional ones use the region name.
+        """
+        reserved_index = {}
         try:
-            logger.debug("Try to get in the instance, the memory available.")
-            if instance_ip and instance_ssh_key:
-                dict_mem_info = ssh_os_linux_available_memory(instance_ip, instance_ssh_key)
-                if dict_mem_info['percent_free'] > 0:
-                    logger.info("Memory available metric has been captured with success on {}:{}".format(instance_id,
-                                                                                                         instance_region))
+            rs = self.aws_clients.call('ec2', instance_region, 'describe_reserved_instances',
+                                       Filters=[{'Name': 'state', 'Values': [state]}])
+            for reservation in rs.get('ReservedInstances', []):
+                if 'Region' in reservation['Scope']:
+                    zone = instance_region
+                else:
+                    zone = reservation['AvailabilityZone']
+                key = (reservation['InstanceType'], zone, reservation['Scope'])
+                reserved_index.setdefault(key, []).append({
+                    'reservedinstancesid': reservation['ReservedInstancesId'],
+                    'available_count': int(reservation['InstanceCount']),
+                    'reservedprice': reservation['UsagePrice'],
+                    'offeringclass': reservation['OfferingClass']
+                })
+            logger.debug("Loaded {} reservations of region {}".format(len(rs.get('ReservedInstances', [])),
+                                                                       instance_region))
         except Exception as e:
-            logger.exception(
-                "It was not possible to collect the memory information of instance {}-{} - {}".format(instance_id,
-                                                                                                      instance_region,
-                                                                                                      e), exc_info=True)
-        finally:
-            return dict_mem_info
+            logger.error("Error on get reserved information of region {}: {}".format(instance_region, e))
+        self.reserved_index[instance_region] = reserved_index
 
-    def __get_instance_report_agg(self, instance_id, instance_region, aggregation_type='days', aggregation=14,
-                                  period=3600):
+    def __match_reserved_instance(self, instance_id, instance_region, instance_type, availability_zone):
+        """
+        Assign the instance to a reservation with free InstanceCount, zonal reservations first and then the
+        regional ones. Each instance consumes one unit of the reservation's InstanceCount.
 
-        if 'days' in aggregation_type:
-            starttime = datetime.today() - timedelta(days=int(aggregation))
-        if 'minutes' in aggregation_type:
-            starttime = datetime.today() - timedelta(minutes=int(aggregation))
+        :return: the ReservedInstancesId or None when the instance runs as on demand.
+        """
+        with self.lock:
+            if instance_id in self.reserved_assignments:
+                return self.reserved_assignments[instance_id]
+            if instance_region not in self.reserved_index:
+                self.__load_reserved_instances(instance_region)
+
+            reservationid = None
+            reserved_index = self.reserved_index[instance_region]
+            for key in [(instance_type, availability_zone, 'Availability Zone'),
+                        (instance_type, instance_region, 'Region')]:
+                for reservation in reserved_index.get(key, []):
+                    if reservation['available_count'] > 0:
+                        reservation['available_count'] -= 1
+                        reservationid = reservation['reservedinstancesid']
+                        break
+                if reservationid is not None:
+                    break
+            self.reserved_assignments[instance_id] = reservationid
+            return reservationid
+
+    def __match_reserved_instances(self, instances, carried):
+        """
+        Match the running instances to the reservations in the order of the inventory, before the workers start,
+        so the instances that consume the InstanceCount of each reservation do not depend on the order the workers
+        finish. get_instance_details() then finds the assignment already done.
+        """
+        for instance in instances:
+            inventory_instance = self.instances_inventory.get(instance['id'])
+            if instance['id'] in carried or inventory_instance is None or \
+                    int(inventory_instance['State']['Code']) != 16:
+                continue
+            self.__match_reserved_instance(instance['id'], instance['region'], str(inventory_instance['InstanceType']),
+                                           str(inventory_instance['Placement']['AvailabilityZone']))
+
+    def __claim_reserved_instance(self, instance_id, instance_region, reservationid):
+        """
+        Assign the instance again to the reservation it had in the last scan, if the reservation is still
+        active and has free InstanceCount.
 
-        endtime = datetime.today()
+        :return: True when the reservation has been claimed.
+        """
+        with self.lock:
+            if instance_region not in self.reserved_index:
+                self.__load_reserved_instances(instance_region)
+            for reservations in self.reserved_index[instance_region].values():
+                for reservation in reservations:
+                    if reservation['reservedinstancesid'] == reservationid and reservation['available_count'] > 0:
+                        reservation['available_count'] -= 1
+                        self.reserved_assignments[instance_id] = reservationid
+                        return True
+            return False
+
+    def __get_carried_instances(self, instances):
+        """
+        Incremental scan: the snapshot entries of the instances unchanged since the last full scan, their static
+        details and SSH memory info are carried forward and only the metrics are refreshed.
 
-        cpu = round(self.__avg_cloudwatch_metrics(
-            self.__cloudwatch_ec2(instance_id, instance_region, 'CPUUtilization', starttime, endtime, period)), 2)
-        diskr = round(self.__avg_cloudwatch_metrics(
-            self.__cloudwatch_ec2(instance_id, instance_region, 'DiskReadOps', starttime, endtime, period)), 2)
-        diskw = round(self.__avg_cloudwatch_metrics(
-            self.__cloudwatch_ec2(instance_id, instance_region, 'DiskWriteOps', starttime, endtime, period)), 2)
-        netin = round(self.__avg_cloudwatch_metrics(
-            self.__cloudwatch_ec2(instance_id, instance_region, 'NetworkIn', starttime, endtime, period)), 2)
-        netou = round(self.__avg_cloudwatch_metrics(
-            self.__cloudwatch_ec2(instance_id, instance_region, 'NetworkOut', starttime, endtime, period)), 2)
-
-        # Get more details from instance-id: SSHKEY, TAGS, IP AND OTHERS.
-        details = self.get_instance_details(instance_id, instance_region)
-
-        # Get memory info thougth SSH
-        instance_ip = details['instanceIP']
-        instance_ssh_key = details['SSHKey']
-        dict_mem_info = self.__get_instance_ssh_memory_info(instance_ip, instance_ssh_key, instance_id,
-                                                            instance_region, )
+        :return: tuple (dict {instance_id: snapshot entry} of the unchanged instances,
+            dict {instance_id: fingerprint} of all instances)
+        """
+        snapshot = get_scan_snapshot()
+        fingerprints = {}
+        carried = {}
+        for instance in instances:
+            inventory_instance = self.instances_inventory.get(instance['id'])
+            if inventory_instance is None:
+                continue
+            inasg, asg_name = self.__check_instance_in_asg(instance['id'], instance['region'])
+            fingerprints[instance['id']] = instance_fingerprint(inventory_instance, asg_name)
+            entry = snapshot.get(instance['id'], fingerprints[instance['id']])
+            if entry is None:
+                continue
+            # The reservations of the last scan are claimed first, before any other instance is matched.
+            reservationid = entry['details'].get('instance_reservation_id')
+            if reservationid is not None and not self.__claim_reserved_instance(instance['id'], instance['region'],
+                                                                                 reservationid):
+                continue
+            carried[instance['id']] = dict(entry, details=dict(entry['details']))
+
+        # Unchanged on demand instances may fit into a reservation bought since the last scan.
+        for instance in instances:
+            entry = carried.get(instance['id'])
+            if entry is not None and entry['details'].get('instance_reservation_id') is None and \
+                    entry['details'].get('InstanceState') == 'running':
+                entry['details']['instance_reservation_id'] = self.__match_reserved_instance(
+                    instance['id'], instance['region'], entry['details']['instance_type'],
+                    entry['details']['instance_availabilityzone'])
+        logger.info("Incremental scan: {} of {} instances unchanged since the last scan".format(len(carried),
+                                                                                           len(instances)))
+        return carried, fingerprints
+
+    def __save_scan_snapshot(self, accumulator, fingerprints, carried):
+        memory_columns = list(self.__memory_report_fields(default_mem_info()).keys()) + ['MemorySource']
+        now = get_timestp()
+        entries = {}
+        for report in accumulator.records(['InstanceId'] + memory_columns):
+            instance_id = report['InstanceId']
+            if instance_id not in fingerprints or instance_id not in self.scan_details:
+                continue
+            timestamp = carried[instance_id]['timestamp'] if instance_id in carried else now
+            entries[instance_id] = {'fingerprint': fingerprints[instance_id],
+                                    'timestamp': timestamp,
+                                    'details': self.scan_details[instance_id],
+                                    'memory': dict((column, report[column]) for column in memory_columns)}
+        get_scan_snapshot().replace(entries)
+
+    def __phase1_mask(self, df, max_cpu=None, network_io=None):
+        """
+        Phase 1 of the filter, shared by __filter_low_utilization_instances() and the SSH memory probe: low use
+        of cpu and low use of NetIO, and of the p95 of cpu when criteria_percent_p95_cpu is set. The instances
+        without metrics (None) never match.
+
+        :return: boolean Series with the index of df.
+        """
+        cpu = pd.to_numeric(df['CPU'], errors='coerce')
+        network_io_aggr = pd.to_numeric(df['NetworkIOBytes_aggr'], errors='coerce')
+        mask = cpu.notna() & network_io_aggr.notna()
+        if max_cpu is None or network_io is None:
+            return mask
+        # AWS uses as formula to criteria in networkIO in  this way:
+        # network_in + network_out <=  x
+        network_io_bytes = int(network_io) * (1024 ** 2)
+        mask &= (cpu <= max_cpu) & (network_io_aggr <= network_io_bytes)
+        # Optional richer criteria, the p95 of CPU says if the instance has peaks of use.
+        max_cpu_p95 = config_fallback(main_config['criteria_percent_p95_cpu'], fallback=None)
+        if max_cpu_p95 is not None and 'CPU_p95' in df:
+            mask &= pd.to_numeric(df['CPU_p95'], errors='coerce') <= max_cpu_p95
+        return mask
+
+    def __get_instances_ssh_memory_info(self, accumulator, max_cpu=None, network_io=None):
+        """
+        Submit the SSH memory probe at once for all instances without CloudWatch Agent memory metric that
+        pass the phase 1 criteria (cpu + network) and have IP and SSH key, and update their reports.
+        The others are marked as not probed.
+        """
+        hosts = []
+        columns = ['InstanceId', 'CPU', 'CPU_p95', 'NetworkIOBytes_aggr', 'instanceIP', 'SSHKey', 'instance_ami',
+                   'MemorySource', 'MemoryProbeStatus']
+        reports = list(accumulator.records(columns))
+        candidates = self.__phase1_mask(pd.DataFrame(reports, columns=columns), max_cpu, network_io).tolist()
+        for report, candidate in zip(reports, candidates):
+            if report['MemoryProbeStatus'] == MEMORY_CARRIED:
+                continue
+            if report['MemorySource'] == MEMORY_SOURCE_AGENT or not candidate:
+                memory_probe_status = MEMORY_NOT_PROBED
+            elif report['instanceIP'] and report['SSHKey']:
+                # Its MemoryProbeStatus is the outcome of the probe, set below.
+                hosts.append({'id': report['InstanceId'], 'host_ip': report['instanceIP'],
+                              'host_key': report['SSHKey'], 'image_id': report['instance_ami']})
+                continue
+            else:
+                memory_probe_status = MEMORY_NO_ACCESS
+            accumulator.update(report['InstanceId'], {'MemoryProbeStatus': memory_probe_status})
+        logger.info("Getting memory info through SSH of {} phase 1 candidates of {} instances".format(
+            len(hosts), len(accumulator)))
+        memory_info = ssh_memory_probe_batch(hosts)
+        for instance_id, (probe_status, dict_mem_info) in memory_info.items():
+            fields = self.__memory_report_fields(dict_mem_info)
+            fields['MemorySource'] = self.__ssh_memory_source(dict_mem_info)
+            fields['MemoryProbeStatus'] = probe_status
+            accumulator.update(instance_id, fields)
+
+    def __ssh_memory_source(self, dict_mem_info):
+        if dict_mem_info['percent_free'] is not None and dict_mem_info['percent_free'] > 0:
+            return MEMORY_SOURCE_SSH
+        return MEMORY_SOURCE_NONE
+
+    def __memory_report_fields(self, dict_mem_info):
+        return {"TotalMemoryBytes": dict_mem_info['memtotal'],
+                "AvailiableMemoryBytes": dict_mem_info['memavailable'],
+                "AvailiableMemoryPerc": dict_mem_info['percent_free'],
+                "kernel": dict_mem_info['kernel'],
+                "distro": dict_mem_info['distro']
+                }
+
+    def __get_instance_report_agg(self, instance_id, instance_region, metrics, aggregation_type='days',
+                                  aggregation=14, period=3600, carried=None):
+
+        cpu = round_or_none(metrics['CPUUtilization'])
+        cpu_max = round_or_none(metrics['CPUUtilization_max'])
+        cpu_p95 = round_or_none(metrics['CPUUtilization_p95'])
+        cpu_idle_hours = round_or_none(metrics['CPUIdleHours'] * 100 if metrics['CPUIdleHours'] is not None else None)
+        diskr = round_or_none(metrics['DiskReadOps'])
+        diskw = round_or_none(metrics['DiskWriteOps'])
+        netin = round_or_none(metrics['NetworkIn'])
+        netou = round_or_none(metrics['NetworkOut'])
+        netio = netin + netou if netin is not None and netou is not None else None
+
+        # Get more details from instance-id: SSHKEY, TAGS, IP AND OTHERS, or carry forward the ones of the last
+        # scan when the instance is unchanged.
+        if carried is not None:
+            details = carried['details']
+        else:
+            details = self.get_instance_details(instance_id, instance_region)
+        with self.lock:
+            self.scan_details[instance_id] = details
+
+        # Get memory info from the CloudWatch Agent, the SSH fallback is collected later in batch by
+        # __get_instances_ssh_memory_info()
+        dict_mem_info = default_mem_info()
+        memory_probe_status = MEMORY_NOT_PROBED
+        memory_source = MEMORY_SOURCE_NONE
+        carried_memory = None
+        if metrics.get(AGENT_MEMORY_METRIC) is not None:
+            dict_mem_info['percent_free'] = round(metrics[AGENT_MEMORY_METRIC], 2)
+            memory_source = MEMORY_SOURCE_AGENT
+        elif carried is not None and carried['memory'].get('MemorySource') == MEMORY_SOURCE_SSH:
+            carried_memory = carried['memory']
+            memory_probe_status = MEMORY_CARRIED
+            memory_source = MEMORY_SOURCE_SSH
 
         aggr_info = {"InstanceId": instance_id,
                      "InstanceRegion": instance_region,
                      "CPU": cpu,
-                     "TotalMemoryBytes": dict_mem_info['memtotal'],
-                     "AvailiableMemoryBytes": dict_mem_info['memavailable'],
-                     "AvailiableMemoryPerc": dict_mem_info['percent_free'],
-                     "kernel": dict_mem_info['kernel'],
-                     "distro": dict_mem_info['distro'],
+                     "CPU_max": cpu_max,
+                     "CPU_p95": cpu_p95,
+                     "CPUIdleHoursPerc": cpu_idle_hours,
                      "DiskRead": diskr,
                      "DiskWrite": diskw,
-                     "NetworkIOBytes_aggr": netin + netou,
+                     "NetworkIOBytes_aggr": netio,
                      "NetworkInBytes_aggr": netin,
                      "NetworkOutBytes_aggr": netou,
-                     "NetworkInBytesSec": int(netin / period),
-                     "NetworkOutBytesSec": int(netou / period),
+                     "NetworkInBytesSec": int(netin / period) if netin is not None else None,
+                     "NetworkOutBytesSec": int(netou / period) if netou is not None else None,
+                     "MetricsStatus": metrics.get('MetricsStatus', METRICS_OK),
                      "AggregationType": aggregation_type,
                      "Aggregation_time": aggregation,
-                     "Aggregation_period": period
+                     "Aggregation_period": period,
+                     "MemoryProbeStatus": memory_probe_status,
+                     "MemorySource": memory_source
                      }
+        aggr_info.update(self.__memory_report_fields(dict_mem_info))
+        if carried_memory is not None:
+            aggr_info.update(carried_memory)
+        aggr_info.update(self.__windows_report_fields(metrics.get('Windows', {})))
 
         try:
             # Concat the Aggr_info + details into a new single dict.
@@ -234,45 +678,108 @@ class AWSInterface(object):
                              exc_info=True)
             pass
 
+    @staticmethod
+    def __windows_report_fields(windows):
+        # One column per window and statistic, e.g. CPU_7d, so the recent and long term idleness can be compared.
+        fields = {}
+        for label, stats in windows.items():
+            fields["CPU_{}".format(label)] = round_or_none(stats['CPUUtilization'])
+            fields["CPU_p95_{}".format(label)] = round_or_none(stats['CPUUtilization_p95'])
+            fields["CPUIdleHoursPerc_{}".format(label)] = round_or_none(
+                stats['CPUIdleHours'] * 100 if stats['CPUIdleHours'] is not None else None)
+            fields["NetworkIOBytes_{}".format(label)] = round_or_none(
+                stats['NetworkIn'] + stats['NetworkOut']
+                if stats['NetworkIn'] is not None and stats['NetworkOut'] is not None else None)
+        return fields
+
+    def __load_inventory_reservations(self, reservations, instance_region):
+        with self.lock:
+            for reservation in reservations:
+                for instance in reservation['Instances']:
+                    instance['OwnerId'] = reservation['OwnerId']
+                    instance['Region'] = instance_region
+                    self.instances_inventory[instance['InstanceId']] = instance
+
+    def __get_inventory_instance(self, instance_id, instance_region):
+        """
+        Return the describe_instances record of instance_id from the in-memory inventory loaded by
+        get_simple_instances_list(), calling the EC2 API only if the instance is not there yet.
+        """
+        if instance_id not in self.instances_inventory:
+            logger.debug("Instance {}:{} not found in inventory, describing it...".format(instance_id, instance_region))
+            with self.limiter.limit('ec2', instance_region):
+                rs = self.aws_clients.call('ec2', instance_region, 'describe_instances', InstanceIds=[instance_id])
+            self.__load_inventory_reservations(rs['Reservations'], instance_region)
+        return self.instances_inventory[instance_id]
+
+    def __process_instance(self, instance, aggregation_unit, aggregation_value, metrics, carried=None):
+        """
+        Worker of get_low_utilization_instances(), it returns the report of one instance (None on failure).
+        """
+        with self.limiter.limit('region', instance['region']):
+            logger.debug("-----------------------------------------------------------------------------")
+            logger.info("Starting process to instance-id {}:{}".format(instance['id'], instance['region']))
+            return self.__get_instance_report_agg(instance_id=instance['id'],
+                                                  instance_region=instance['region'],
+                                                  aggregation_type=aggregation_unit,
+                                                  aggregation=aggregation_value,
+                                                  period=3600,
+                                                  metrics=metrics,
+                                                  carried=carried)
+
     """
     When we call get_low_utilization_instances() all methods (private and public) is used to compose them. 
     However, you can use individually the others public methods to get specific information
     """
 
-    def get_ec2_price(self, instance_type, instance_region):
+    def get_ec2_price(self, instance_type, instance_region, tenancy='Shared', operating_system='Linux',
+                      offer_term=RESERVED_OFFER_TERM):
+        cache = get_price_cache()
+        key = cache.make_key(instance_type, instance_region, tenancy, operating_system, offer_term)
+        # One lookup per key even when many workers ask for the same instance type at the same time.
+        with cache.key_lock(key):
+            cost_dict = cache.get(key)
+            if cost_dict is None:
+                with self.limiter.limit('pricing'):
+                    cost_dict = self.__get_ec2_price_api(instance_type, instance_region, tenancy, operating_system,
+                                                         offer_term)
+                cache.set(key, cost_dict)
+        return cost_dict
+
+    def __get_ec2_price_api(self, instance_type, instance_region, tenancy, operating_system, offer_term):
         try:
             #  By the doc, I need to force Virginia as region to do it works.
             #  http://docs.aws.amazon.com/awsaccountbilling/latest/aboutv2/using-pelong.html
-            price_connection = self.aws_connection.client('pricing', region_name='us-east-1')
             region_full_name = self.__aws_region_convert(instance_region)
-            rs = price_connection.get_products(ServiceCode='AmazonEC2',
-                                               Filters=[
-                                                   {'Type': 'TERM_MATCH',
-                                                    'Field': "instanceType",
-                                                    'Value': instance_type
-                                                    },
-
-                                                   {'Type': 'TERM_MATCH',
-                                                    'Field': "tenancy",
-                                                    'Value': "Shared"
-                                                    },
-
-                                                   {'Type': 'TERM_MATCH',
-                                                    'Field': "servicename",
-                                                    'Value': "Amazon Elastic Compute Cloud"
-                                                    },
-
-                                                   {'Type': 'TERM_MATCH',
-                                                    'Field': "operatingSystem",
-                                                    'Value': "Linux"
-                                                    },
-
-                                                   {'Type': 'TERM_MATCH',
-                                                    'Field': "location",
-                                                    'Value': region_full_name
-                                                    }
-                                               ]
-                                               )
+            rs = self.aws_clients.call('pricing', 'us-east-1', 'get_products',
+                                       ServiceCode='AmazonEC2',
+                                       Filters=[
+                                           {'Type': 'TERM_MATCH',
+                                            'Field': "instanceType",
+                                            'Value': instance_type
+                                            },
+
+                                           {'Type': 'TERM_MATCH',
+                                            'Field': "tenancy",
+                                            'Value': tenancy
+                                            },
+
+                                           {'Type': 'TERM_MATCH',
+                                            'Field': "servicename",
+                                            'Value': "Amazon Elastic Compute Cloud"
+                                            },
+
+                                           {'Type': 'TERM_MATCH',
+                                            'Field': "operatingSystem",
+                                            'Value': operating_system
+                                            },
+
+                                           {'Type': 'TERM_MATCH',
+                                            'Field': "location",
+                                            'Value': region_full_name
+                                            }
+                                       ]
+                                       )
         except Exception as e:
             logger.error("error to get result price with price api {}".format(e))
         price_list = rs['PriceList'][0]
@@ -304,7 +811,7 @@ class AWSInterface(object):
         '4NA7Y494T4' - {'LeaseContractLength': '1yr', 'OfferingClass': 'standard', 'PurchaseOption': 'No Upfront'}
         '''
         # Reserved without up front
-        keys_reserved = "{}.4NA7Y494T4".format(sku)
+        keys_reserved = "{}.{}".format(sku, offer_term)
         priced_riidx = str(list(json_items['terms']['Reserved'][keys_reserved]['priceDimensions'].keys())[0])
         unit_reserved = json_items['terms']['Reserved'][keys_reserved]['priceDimensions'][priced_riidx]['unit']
         price_reserved = \
@@ -337,7 +844,7 @@ class AWSInterface(object):
                      'cost_month_ondemand': round(cost_month_ondemand, 6),
                      'unit_reserved': unit_reserved,
                      'price_reserved': round(float(price_reserved), 6),
-                     'reserved_offer_term_code': '4NA7Y494T4 - 1yr standard No Upfront',
+                     'reserved_offer_term_code': '{} - {}'.format(offer_term, RESERVED_OFFER_TERMS.get(offer_term)),
                      'cost_month_reserved': round(cost_month_reserved, 6),
                      'percent_difference': round(percent_difference, 6),
                      'save_money_month': round(save_money, 2)
@@ -345,8 +852,7 @@ class AWSInterface(object):
         return cost_dict
 
     def get_instance_details(self, instance_id, instance_region):
-        ec2_connection = self.aws_connection.client('ec2', region_name=instance_region)
-        rs = ec2_connection.describe_instances(InstanceIds=[instance_id])
+        instance = self.__get_inventory_instance(instance_id, instance_region)
         inasg = None
         asg_name = None
         launchtime = None
@@ -370,39 +876,39 @@ class AWSInterface(object):
             pass
 
         try:
-            launchtime = datetime_iso8601((rs['Reservations'][0]['Instances'][0]['LaunchTime']))
+            launchtime = datetime_iso8601(instance['LaunchTime'])
         except:
             logger.warning("Error to get launchtime of instance {}:{}", format(instance_id, instance_region))
             pass
 
         # If inasg = True then not exist KeyName.
         try:
-            sshkey = str(rs['Reservations'][0]['Instances'][0]['KeyName'])
+            sshkey = str(instance['KeyName'])
         except:
             pass
 
-        imageid = str(rs['Reservations'][0]['Instances'][0]['ImageId'])
-        instance_type = str(rs['Reservations'][0]['Instances'][0]['InstanceType'])
+        imageid = str(instance['ImageId'])
+        instance_type = str(instance['InstanceType'])
         instance_family = str(instance_type.split('.')[0])
         instance_family_generation = instance_family[1:]
 
-        ebs_optimized = convert_anything_to_bool(rs['Reservations'][0]['Instances'][0]['EbsOptimized'])
-        state = str(rs['Reservations'][0]['Instances'][0]['State']['Name'])
-        state_code = int(rs['Reservations'][0]['Instances'][0]['State']['Code'])
+        ebs_optimized = convert_anything_to_bool(instance['EbsOptimized'])
+        state = str(instance['State']['Name'])
+        state_code = int(instance['State']['Code'])
 
         # state  codes
         # 0(pending), 16(running), 32(shutting - down), 48(terminated), 64(stopping), and 80(stopped).
         if state_code in [16, 64, 80]:
-            private_ip_address = rs['Reservations'][0]['Instances'][0]['PrivateIpAddress']
-            private_dns_name = rs['Reservations'][0]['Instances'][0]['PrivateDnsName']
-            vpcid = rs['Reservations'][0]['Instances'][0]['VpcId']
-            subnetid = rs['Reservations'][0]['Instances'][0]['SubnetId']
+            private_ip_address = instance['PrivateIpAddress']
+            private_dns_name = instance['PrivateDnsName']
+            vpcid = instance['VpcId']
+            subnetid = instance['SubnetId']
 
-        availability_zone = str(rs['Reservations'][0]['Instances'][0]['Placement']['AvailabilityZone'])
-        ownerid = str(rs['Reservations'][0]['OwnerId'])
+        availability_zone = str(instance['Placement']['AvailabilityZone'])
+        ownerid = str(instance['OwnerId'])
 
         try:
-            tags = list(rs['Reservations'][0]['Instances'][0]['Tags'])
+            tags = list(instance['Tags'])
             details = {}
             tag_dict = {}
             tags_black_list = main_config['aws_tag_exclude']
@@ -415,11 +921,11 @@ class AWSInterface(object):
             logger.exception("Error on capture tags", exc_info=True)
             pass
 
-        reserved_info = self.__reserved_instances(instance_region, instance_type, availability_zone)
+        # Reservations are only billed against running instances.
         reservationid = None
-        if reserved_info:
-            if instance_region == reserved_info['availabilityzone']:
-                reservationid = reserved_info['reservedinstancesid']
+        if state_code == 16:
+            reservationid = self.__match_reserved_instance(instance_id, instance_region, instance_type,
+                                                           availability_zone)
 
         details.update({
             "InstanceState": state,
@@ -460,6 +966,7 @@ class AWSInterface(object):
 
                :return:
                    a list with dictionary containts two key: id and region with instance_id  and instance region.
+                   The full describe_instances record of each instance is kept in self.instances_inventory.
 
         """
         if "all" in state:
@@ -475,18 +982,42 @@ class AWSInterface(object):
 
         instance_list = []
         try:
+            # Every region is listed in its own thread, so a slow region does not hold up the others, and all of
+            # them share one deadline.
+            timeout = config_fallback(main_config['aws_region_discovery_timeout'], fallback=None)
+            executor = ThreadPoolExecutor(max_workers=max(len(self.aws_regions), 1))
+            futures = dict((region, executor.submit(self.__list_region_instances, region, filters))
+                           for region in self.aws_regions)
+            done, _ = wait(futures.values(), timeout=timeout)
             for region in self.aws_regions:
-                logger.info("Getting instances list of regions {}".format(region))
-                ec2_connection = self.aws_connection.resource('ec2', region_name=region)
-                instances = ec2_connection.instances.filter(Filters=filters)
-                for instance in instances:
-                    logger.debug("Loading in instance list id:{}  - region: {}".format(instance.id, region))
-                    instance_list.append({"id": instance.id, "region": region})
-                logger.debug("Finish Loading in instance list...")
+                if futures[region] not in done:
+                    futures[region].cancel()
+                    logger.error("Region {} not listed in {}s, its instances are left out".format(region, timeout))
+                    continue
+                try:
+                    region_list, elapsed = futures[region].result()
+                    logger.info("Region {} listed {} instances in {:.2f}s".format(region, len(region_list), elapsed))
+                    instance_list.extend(region_list)
+                except Exception:
+                    logger.exception("Error on get_simple_instances_list of region {}".format(region), exc_info=True)
+            executor.shutdown(wait=False)
+            logger.debug("Finish Loading in instance list...")
             return instance_list
         except Exception:
             logger.exception("Error on get_simple_instances_list", exc_info=True)
 
+    def __list_region_instances(self, region, filters):
+        starttime = time.time()
+        region_list = []
+        logger.info("Getting instances list of regions {}".format(region))
+        for page in self.aws_clients.paginate('ec2', region, 'describe_instances', Filters=filters):
+            self.__load_inventory_reservations(page['Reservations'], region)
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    logger.debug("Loading in instance list id:{}  - region: {}".format(instance['InstanceId'], region))
+                    region_list.append({"id": instance['InstanceId'], "region": region})
+        return region_list, time.time() - starttime
+
     # IF CPU <=50% and NetworkIO <= 500Mb &FreeMemory >= 50%
     def __filter_low_utilization_instances(self, df_all_instances, max_cpu=None, max_mem_available_pct=None,
                                            network_io=None):
@@ -495,15 +1026,12 @@ class AWSInterface(object):
         Phase 1: Get all instances with low use of cpu and low use of NetIO
         Phase 2: Check in list of phase 1 the low use memory to a final list.
         ALL -> criteria cpu+network  -> memory = low inst. list
+        The memory is only collected for the instances of phase 1 (see __get_instances_ssh_memory_info()).
         """
         # finding the low utilization instances using the criteria...
-        # AWS uses as formula to criteria in networkIO in  this way:
-        # network_in + network_out <=  x
-        network_io_bytes = int(network_io) * (1024 ** 2)
-        df_low = df_all_instances[
-            (df_all_instances['CPU'] <= max_cpu) & (df_all_instances['NetworkIOBytes_aggr'] <= network_io_bytes)]
-        df_low = df_low[
-            (df_low['AvailiableMemoryPerc'] < 0) | (df_low['AvailiableMemoryPerc'] >= max_mem_available_pct)]
+        df_low = df_all_instances[self.__phase1_mask(df_all_instances, max_cpu, network_io)]
+        memory_available = pd.to_numeric(df_low['AvailiableMemoryPerc'], errors='coerce')
+        df_low = df_low[(memory_available < 0) | (memory_available >= max_mem_available_pct)]
         return df_low
 
     def get_low_utilization_instances(self, instance_id=None, instance_region=None, tag_key=None, tag_value=None,
@@ -537,51 +1065,90 @@ class AWSInterface(object):
             df = picke_to_dataframe(pick_file)
             pick_load = True
         else:
+            aggregation_value = config_fallback(main_config['criteria_aggregation_value'], 14)
+            aggregation_unit = config_fallback(main_config['criteria_aggegation_unit'], 'days')
+            # A single fetch of the longest window, the other windows are slices of the same datapoints.
+            longest, windows = self.__get_aggregation_windows(aggregation_unit, aggregation_value)
+            starttime, endtime = self.__get_aggregation_window(aggregation_unit, longest)
+            aggregation_seconds = self.__aggregation_seconds(aggregation_unit, aggregation_value)
+
+            # Collecting the CloudWatch metrics and ASG membership region by region before process each instance.
+            region_instances = {}
             for instance in instances:
-                try:
+                region_instances.setdefault(instance['region'], []).append(instance['id'])
+            metrics = {}
+            for region, instances_ids in region_instances.items():
+                logger.info("Getting metrics of {} instances of region {}".format(len(instances_ids), region))
+                metrics[region] = self.__get_region_metrics(instances_ids, region, starttime, endtime, period=3600,
+                                                            aggregation_seconds=aggregation_seconds,
+                                                            windows=windows)
+                self.__load_asg_instances(region)
+
+            # Incremental mode, only for full scans: the unchanged instances are not processed from scratch.
+            incremental = convert_anything_to_bool(config_fallback(main_config['system_incremental_scan'],
+                                                                   fallback=False)) and instance_id is None and \
+                not self.test_mode
+            carried = {}
+            fingerprints = {}
+            if incremental:
+                carried, fingerprints = self.__get_carried_instances(instances)
+            self.__match_reserved_instances(instances, carried)
+
+            workers = int(config_fallback(main_config['system_scan_workers'], fallback=1))
+            logger.info("Processing {} instances with {} workers".format(total_instances, workers))
+            accumulator = ReportAccumulator(key_column='InstanceId')
+            # The workers finish in any order, the reports are kept by position and appended in the order of
+            # the inventory.
+            reports = [None] * len(instances)
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                futures = {}
+                for position, instance in enumerate(instances):
+                    future = executor.submit(self.__process_instance, instance, aggregation_unit,
+                                             aggregation_value, metrics[instance['region']][instance['id']],
+                                             carried.get(instance['id']))
+                    futures[future] = (position, instance)
+
+                for future in as_completed(futures):
+                    position, instance = futures[future]
                     instances_processed += 1
-                    logger.debug("-----------------------------------------------------------------------------")
-                    logger.debug("Starting process to instance-id {}:{}".format(instance['id'], instance['region']))
-                    logger.info("Starting process to instance-id {}:{}".format(instance['id'], instance['region']))
                     processed_perc = round((instances_processed * 100 / total_instances), 1)
-                    logger.debug(
-                        "processed {}% - processing instance {}:{}....".format(processed_perc, instance['id'],
-                                                                               instance['region']))
-                    aggregation_value = config_fallback(main_config['criteria_aggregation_value'], 14)
-                    aggregation_unit = config_fallback(main_config['criteria_aggegation_unit'], 'days')
-                    instance_report_dict = self.__get_instance_report_agg(instance_id=instance['id'],
-                                                                          instance_region=instance['region'],
-                                                                          aggregation_type=aggregation_unit,
-                                                                          aggregation=aggregation_value,
-                                                                          period=3600)
-                    df = pd.concat([df, convert_dict_dataframe(instance_report_dict)])
-                    if logging.getLevelName("INFO"):
-                        logger.info("Running... Pocessed {}% of ".format(processed_perc, total_instances))
-                    else:
-                        logger.warning("Running... Pocessed {}% of {}".format(processed_perc, total_instances))
-
-                except (Exception, KeyError, IndexError) as e:
-                    logger.critical(
-                        "Error {}  to get metrics and saving into the dataframe for instance {} of {}".format(e,
-                                                                                                              instance[
-                                                                                                                  'id'],
-                                                                                                              instance[
-                                                                                                                  'region']),
-                        exc_info=True)
-                    pass
+                    try:
+                        reports[position] = future.result()
+                        logger.debug(
+                            "processed {}% - processed instance {}:{}....".format(processed_perc, instance['id'],
+                                                                                 instance['region']))
+                        if logging.getLevelName("INFO"):
+                            logger.info("Running... Pocessed {}% of {}".format(processed_perc, total_instances))
+                        else:
+                            logger.warning("Running... Pocessed {}% of {}".format(processed_perc, total_instances))
+
+                    except (Exception, KeyError, IndexError) as e:
+                        logger.critical(
+                            "Error {}  to get metrics and saving into the dataframe for instance {} of {}".format(
+                                e, instance['id'], instance['region']), exc_info=True)
+                        pass
+            for report in reports:
+                if report is not None:
+                    accumulator.append(report)
+
+            # Phase 2 is expensive (SSH), so only the instances that pass the phase 1 criteria are probed.
+            self.__get_instances_ssh_memory_info(accumulator, max_cpu=max_cpu, network_io=network_io)
+
+            if incremental:
+                self.__save_scan_snapshot(accumulator, fingerprints, carried)
+
+            df = accumulator.to_dataframe()
+
+        logger.info("Price cache stats: {}".format(get_price_cache().stats()))
+        logger.info("AWS API stats: {}".format(self.aws_clients.stats()))
 
         if self.test_mode and pick_load is False:
             df_to_picke(df, pick_file)
 
-        tags_count = count_tags(df["instance_tags"])
-        untagged_owner = tags_count['untagged_owner']
-        untagged_team = tags_count['untagged_team']
-        untagged_work = tags_count['untagged_work']
-        untagged_owner, tags_count['untagged_owner']
-
         # Finding low utilization...
         # --------------------------
         instances_low_utilizations = 0
+        df_low = df.iloc[0:0]
         try:
 
             "Logic of critecis is in the __filter_low_utilization_instances()"
@@ -594,36 +1161,14 @@ class AWSInterface(object):
 
         # Summarization  of instances...
         # ------------------------------
-        total_instances = 0
-        total_instances_reserved = 0
-        total_instances_on_demand = 0
-        total_cost_reserved = 0
-        total_cost_on_demand = 0
-        total_cost_simulated_ri = 0
-        total_cost_low_utilization_od = 0
-        total_cost_low_utilization_ri = 0
-
+        summary = {'total_instances': df.shape[0], 'total_instances_reserved': 0, 'total_instances_on_demand': 0,
+                   'total_cost_reserved': 0.0, 'total_cost_on_demand': 0.0, 'total_cost_simulated_ri': 0.0,
+                   'total_cost_low_utilization_od': 0.0, 'total_cost_low_utilization_ri': 0.0,
+                   'ri_potential_save': 0.0, 'untagged_owner': 0, 'untagged_team': 0, 'untagged_work': 0,
+                   'by_team': [], 'by_owner': []}
         try:
-            total_instances = df.shape[0]
-            total_instances_reserved = sum(df["instance_reservation_id"].notnull())
-            total_instances_on_demand = sum(df["instance_reservation_id"].isnull())
-
-            # Cost Info...
-            total_cost_reserved = nan2floatzero(
-                df[df["instance_reservation_id"].notnull()]['cost_month_reserved'].sum())
-            total_cost_on_demand = nan2floatzero(
-                df[df["instance_reservation_id"].isnull()]['cost_month_ondemand'].sum())
-
-            total_cost_low_utilization_ri = nan2floatzero(
-                df_low[df_low["instance_reservation_id"].notnull()]['cost_month_reserved'].sum())
-            total_cost_low_utilization_od = nan2floatzero(
-                df_low[df_low["instance_reservation_id"].isnull()]['cost_month_ondemand'].sum())
-
-
-            # Save Money Info
-            total_cost_simulated_ri = nan2floatzero(
-                df[df["instance_reservation_id"].isnull()]['cost_month_reserved'].sum())
-            ri_potential_save = nan2floatzero(df[df["instance_reservation_id"].isnull()]['save_money_month'].sum())
+            summary.update(summarize_instances(df, df_low, tag_keys=('team', 'owner'),
+                                               untagged_keys=('owner', 'team', 'work')))
         except Exception as e:
             logger.error("Error on summarization cost information... - {}".format(e))
             pass
@@ -635,30 +1180,36 @@ class AWSInterface(object):
             report = {
                 "report_date": now,
                 "aggregation_details": {
-                    "total_examined": total_instances,  # "amount_instances_examined": 421,
+                    "total_examined": summary['total_instances'],  # "amount_instances_examined": 421,
                     "total_low_utilization": instances_low_utilizations,
                     "criteria": "cpu <= {}% & mem free >= {}% & netio_aggr <= {}Mb".format(max_cpu,
                                                                                            max_mem_available_pct,
                                                                                            network_io),
-                    "total_untagged_owner": untagged_owner,
-                    "total_untagged_team": untagged_team,
-                    "total_untagged_work": untagged_work,
+                    "total_untagged_owner": summary['untagged_owner'],
+                    "total_untagged_team": summary['untagged_team'],
+                    "total_untagged_work": summary['untagged_work'],
                 },
                 "money_details": {
-                    "total_instances_on_demand": total_instances_on_demand,
-                    "total_instances_reserved": total_instances_reserved,
-                    "total_cost_on_demand": '${:,.2f}'.format(total_cost_on_demand),
-                    "total_cost_reserved": '${:,.2f}'.format(total_cost_reserved),
-                    "total_cost_simulated_ri": '${:,.2f}'.format(total_cost_simulated_ri),
-                    "ri_potential_save": '${:,.2f}'.format(ri_potential_save),
+                    "total_instances_on_demand": summary['total_instances_on_demand'],
+                    "total_instances_reserved": summary['total_instances_reserved'],
+                    "total_cost_on_demand": '${:,.2f}'.format(summary['total_cost_on_demand']),
+                    "total_cost_reserved": '${:,.2f}'.format(summary['total_cost_reserved']),
+                    "total_cost_simulated_ri": '${:,.2f}'.format(summary['total_cost_simulated_ri']),
+                    "ri_potential_save": '${:,.2f}'.format(summary['ri_potential_save']),
+                    "total_cost_low_utilization_on_demand": '${:,.2f}'.format(
+                        summary['total_cost_low_utilization_od']),
+                    "total_cost_low_utilization_reserved": '${:,.2f}'.format(
+                        summary['total_cost_low_utilization_ri']),
                 },
+                "team_details": summary['by_team'],
+                "owner_details": summary['by_owner'],
                 "low_utilization_instances": {},
-                "all_instances:": df.to_dict(orient='records')
+                "all_instances:": df_to_records(df)
             }
 
             # And adding the low utilization instances DICT into the report...
             if instances_low_utilizations > 0:
-                report["low_utilization_instances"] = (df_low.to_dict(orient='records'))
+                report["low_utilization_instances"] = df_to_records(df_low)
                 logger.info("Well done! Not found low utilization instances!!! =) ")
 
             # Return the final result.
@@ -4,6 +4,7 @@ import os
 from api_config import main_config, log_config
 from libs.aws_interface import AWSInterface
 from libs.db_wrapper import DataStore
+from libs.response_cache import get_response_cache
 
 logging.config.dictConfig(log_config)
 logger = logging.getLogger("cloud_wrapper")
@@ -53,6 +54,8 @@ class CloudWrapper:
                                                                  network_io=network_io)
 
             ds.save(db, table, low_utilizations)
+            # The cached API responses are of the previous report.
+            get_response_cache().clear()
         if 'googlecloud' in self.cloud_provider:
             low_utilizations = None
             ds.save('gc_low_utilization', low_utilizations)
@@ -70,10 +73,22 @@ class CloudWrapper:
             return low_utilizations
 
     def get_low_utilization_from_db(self, instance_id=None, instance_region=None, tag_key=None, tag_value=None,
-                                    summary_report=None):
+                                    summary_report=None, tags=None, limit=None):
         ds = DataStore()
         db = "cloud_mon"
         table = "aws_low_utilization"
         low_utilizations = ds.get_low_utilization_db(db, table, instance_id, instance_region, tag_key, tag_value,
-                                                     summary_report)
+                                                     summary_report, tags, limit)
         return low_utilizations
+
+    def get_latest_report_id_from_db(self):
+        ds = DataStore()
+        db = "cloud_mon"
+        table = "aws_low_utilization"
+        return ds.get_latest_report_id_db(db, table)
+
+    def get_summary_history_from_db(self, since=None, limit=None, details=False):
+        ds = DataStore()
+        db = "cloud_mon"
+        table = "aws_low_utilization"
+        return ds.get_summary_history_db(db, table, since, limit, details)
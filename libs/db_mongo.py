@@ -1,13 +1,176 @@
+import atexit
 import logging
+import re
+import threading
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING, monitoring
 from pymongo.errors import PyMongoError
 
 from api_config import main_config, log_config
+from libs.tools import config_fallback
 
 logging.config.dictConfig(log_config)
 logger = logging.getLogger("db_mongo")
 
+# Keys of the report stored as one document per instance, instead of inside the report header document.
+REPORT_INSTANCES_KEY = 'all_instances:'
+REPORT_LOW_UTILIZATION_KEY = 'low_utilization_instances'
+# Fields added to the instance documents, removed when the report is assembled back.
+INSTANCE_REFERENCE_FIELDS = ['_id', 'report_id', 'report_date', 'low_utilization']
+
+# Keys of the report materialized in the summary collection at the end of each scan.
+SUMMARY_KEYS = ['report_date', 'aggregation_details', 'money_details', 'team_details', 'owner_details']
+
+REPORT_STATUS_WRITING = 'writing'
+REPORT_STATUS_DONE = 'done'
+# Fields of the header document used only to write it, removed when the report is assembled back.
+HEADER_REFERENCE_FIELDS = ['status', 'total_instances_documents']
+
+indexed_collections = set()
+indexed_collections_lock = threading.Lock()
+
+
+def instances_collection_name(mongo_collection):
+    return "{}_instances".format(mongo_collection)
+
+
+def summary_collection_name(mongo_collection):
+    return "{}_summary".format(mongo_collection)
+
+
+def done_reports_filter():
+    # The reports saved before the per instance documents have no status and are complete.
+    return {'status': {'$ne': REPORT_STATUS_WRITING}}
+
+
+def tags_query(tags):
+    """
+    Query of the instance documents by tags, {tag_key: tag_value or [tag_value, ...]}, all the keys must match and
+    a list matches any of its values ($in). A value ending with * is a prefix, queried by an anchored regex, so
+    the tag index is still used.
+    """
+    query = {}
+    for tag_key, tag_values in tags.items():
+        if tag_key.startswith('$'):
+            logger.warning("Invalid tag key {} ignored".format(tag_key))
+            continue
+        values = []
+        for tag_value in tag_values if isinstance(tag_values, (list, tuple)) else [tag_values]:
+            if tag_value.endswith('*'):
+                values.append(re.compile('^{}'.format(re.escape(tag_value[:-1]))))
+            else:
+                values.append(tag_value)
+        query['instance_tags.{}'.format(tag_key)] = values[0] if len(values) == 1 else {'$in': values}
+    return query
+
+
+class MongoCommandStats(monitoring.CommandListener):
+    """
+    Counters of the commands sent through the pooled MongoClient: total, failed, in flight and latency. The
+    commands in flight are an approximation of the load, not the number of pool connections.
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.duration_micros = 0
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def __finished(self, event, failed):
+        with self.lock:
+            self.in_flight -= 1
+            self.commands += 1
+            self.failures += 1 if failed else 0
+            self.duration_micros += event.duration_micros
+
+    def succeeded(self, event):
+        self.__finished(event, False)
+
+    def failed(self, event):
+        self.__finished(event, True)
+
+    def stats(self):
+        with self.lock:
+            return {'commands': self.commands, 'failures': self.failures, 'commands_in_flight': self.in_flight,
+                    'max_commands_in_flight': self.max_in_flight,
+                    'avg_ms': round(self.duration_micros / 1000.0 / self.commands, 3) if self.commands else 0.0}
+
+
+mongo_clients = {}
+# The pool options each MongoClient was created with, pymongo 4 has no max_pool_size/min_pool_size attributes.
+mongo_clients_pool_options = {}
+mongo_clients_lock = threading.Lock()
+mongo_command_stats = MongoCommandStats()
+
+
+def get_mongo_client(mongo_server=None):
+    """
+    Return the process-wide MongoClient of mongo_server (mongo-server by default), with the pool sizes, timeouts
+    and read preference of main_config. MongoClient is thread safe and keeps its own connection pool, so it must
+    be shared by all requests instead of being created and closed per request.
+    """
+    mongo_server = config_fallback(mongo_server, fallback=main_config["mongo-server"])
+    with mongo_clients_lock:
+        client = mongo_clients.get(mongo_server)
+        if client is None:
+            pool_options = {
+                'max_pool_size': int(config_fallback(main_config['mongo_max_pool_size'], fallback=100)),
+                'min_pool_size': int(config_fallback(main_config['mongo_min_pool_size'], fallback=0)),
+                'max_idle_time_ms': config_fallback(main_config['mongo_max_idle_time_ms'], fallback=None),
+                'wait_queue_timeout_ms': config_fallback(main_config['mongo_wait_queue_timeout_ms'], fallback=None)}
+            client = MongoClient(
+                "mongodb://{}".format(mongo_server),
+                maxPoolSize=pool_options['max_pool_size'],
+                minPoolSize=pool_options['min_pool_size'],
+                maxIdleTimeMS=pool_options['max_idle_time_ms'],
+                connectTimeoutMS=int(config_fallback(main_config['mongo_connect_timeout_ms'], fallback=20000)),
+                socketTimeoutMS=config_fallback(main_config['mongo_socket_timeout_ms'], fallback=None),
+                serverSelectionTimeoutMS=int(config_fallback(main_config['mongo_server_selection_timeout_ms'],
+                                                             fallback=30000)),
+                waitQueueTimeoutMS=pool_options['wait_queue_timeout_ms'],
+                readPreference=config_fallback(main_config['mongo_read_preference'], fallback='primary'),
+                event_listeners=[mongo_command_stats])
+            mongo_clients[mongo_server] = client
+            mongo_clients_pool_options[mongo_server] = pool_options
+            logger.info("MongoClient of {} has been created".format(mongo_server))
+        return client
+
+
+def close_mongo_clients():
+    with mongo_clients_lock:
+        for mongo_server, client in mongo_clients.items():
+            try:
+                client.close()
+                logger.debug("MongoClient of {} has been closed".format(mongo_server))
+            except Exception as e:
+                logger.error("Error to close MongoClient of {}: {}".format(mongo_server, e))
+        mongo_clients.clear()
+        mongo_clients_pool_options.clear()
+
+
+def mongo_pool_stats():
+    with mongo_clients_lock:
+        clients = dict((mongo_server, dict(mongo_clients_pool_options[mongo_server],
+                                           nodes=["{}:{}".format(host, port) for host, port in client.nodes]))
+                       for mongo_server, client in mongo_clients.items())
+    return {'clients': clients, 'commands': mongo_command_stats.stats()}
+
+
+def init_app(app):
+    """
+    Tie the process-wide MongoClient to the Flask app: created with the app, so the first request does not
+    pay for the connection and server discovery, and closed when the app process exits.
+    """
+    app.extensions['mongo_client'] = get_mongo_client()
+    atexit.register(close_mongo_clients)
+
 
 class Mongo(object):
     mongo_db = None
@@ -15,38 +178,164 @@ class Mongo(object):
 
     def __init__(self, mongo_server=None, mongo_port=27017):
         try:
-            try:
-                if mongo_server is None:
-                    mongo_server = main_config["mongo-server"]
-                client = MongoClient("mongodb://{}".format(mongo_server))
-                self.conn = client
-            except Exception as e:
-                logger.error("Error to connect MongoDB : {}".format(e))
-
+            self.conn = get_mongo_client(mongo_server)
         except Exception as e:
             logger.error("Erro ao conectar no hostname: {0} - {1}".format(mongo_server, e))
 
+    def ensure_indexes(self, mongo_db, mongo_collection):
+        """
+        Create, once per process, the indexes of the report headers and summaries (report_date) and of the instance
+        documents (report_id with InstanceId, InstanceRegion, low_utilization and the mongo_index_tags).
+        """
+        key = (mongo_db, mongo_collection)
+        with indexed_collections_lock:
+            if key in indexed_collections:
+                return
+            db = self.conn[mongo_db]
+            db[mongo_collection].create_index([('report_date', DESCENDING)])
+            instances = db[instances_collection_name(mongo_collection)]
+            instances.create_index([('report_id', ASCENDING), ('InstanceId', ASCENDING)])
+            instances.create_index([('report_id', ASCENDING), ('InstanceRegion', ASCENDING)])
+            instances.create_index([('report_id', ASCENDING), ('low_utilization', ASCENDING)])
+            instances.create_index([('InstanceId', ASCENDING), ('report_date', DESCENDING)])
+            summary = db[summary_collection_name(mongo_collection)]
+            summary.create_index([('report_date', DESCENDING)])
+            summary.create_index([('report_id', ASCENDING)], unique=True)
+            for tag in config_fallback(main_config['mongo_index_tags'], fallback=[]):
+                instances.create_index([('report_id', ASCENDING), ('instance_tags.{}'.format(tag), ASCENDING)])
+            indexed_collections.add(key)
+            logger.debug("Indexes of {}.{} have been created".format(mongo_db, mongo_collection))
+
     def save(self, mongo_db, mongo_collection, data):
+        """
+        Save the report as a small header document in mongo_collection and one document per instance, with the
+        report_id of the header, in <mongo_collection>_instances, written by unordered insert_many in batches of
+        mongo_insert_batch_size. The header is marked as done only after all its instances have been written and its
+        summary has been materialized by save_summary(). When the writing fails before that, for any error, the
+        header, the summary and the instances already written are deleted.
+        """
+        report_id = None
+        done = False
         try:
-            db = self.conn[mongo_db][mongo_collection]
-            inserted = db.insert_one(data)
-            logger.info("Data has been inserted with success in MongoDB : {0}".format(inserted))
+            if data is None:
+                logger.warning("There is no report to save")
+                return None
+            self.ensure_indexes(mongo_db, mongo_collection)
+            db = self.conn[mongo_db]
+            batch_size = int(config_fallback(main_config['mongo_insert_batch_size'], fallback=1000))
+            instances = data.get(REPORT_INSTANCES_KEY) or []
+            low_utilization_ids = set(instance['InstanceId'] for instance in data.get(REPORT_LOW_UTILIZATION_KEY) or [])
+
+            header = dict((key, value) for key, value in data.items()
+                          if key not in [REPORT_INSTANCES_KEY, REPORT_LOW_UTILIZATION_KEY])
+            header['status'] = REPORT_STATUS_WRITING
+            header['total_instances_documents'] = len(instances)
+            inserted = db[mongo_collection].insert_one(header)
+            report_id = inserted.inserted_id
+
+            instances_collection = db[instances_collection_name(mongo_collection)]
+            for batch_start in range(0, len(instances), batch_size):
+                documents = []
+                for instance in instances[batch_start:batch_start + batch_size]:
+                    document = dict(instance)
+                    document['report_id'] = report_id
+                    document['report_date'] = header.get('report_date')
+                    document['low_utilization'] = instance.get('InstanceId') in low_utilization_ids
+                    documents.append(document)
+                instances_collection.insert_many(documents, ordered=False)
+
+            # The summary is written before the header is done, so a done report always has its own summary.
+            self.save_summary(mongo_db, mongo_collection, report_id, data)
+            db[mongo_collection].update_one({'_id': report_id}, {'$set': {'status': REPORT_STATUS_DONE}})
+            done = True
+            logger.info("Report {} has been inserted with success in MongoDB with {} instances".format(
+                report_id, len(instances)))
             return inserted
 
         except PyMongoError as e:
             logger.error("Error on insert data - Mongodb {}".format(e))
             logger.info("I have tried to write this data: {}".format(data))
+        except Exception as e:
+            # e.g. bson.errors.InvalidDocument, raised while encoding a batch of documents.
+            logger.exception("Error on insert data - {}".format(e), exc_info=True)
         finally:
-            try:
-                self.conn.close()
-                logger.debug("Connection with mongo has finished")
-                pass
-            except Exception as e:
-                logger.error("Error to finish MongoDB connection: {}".format(e))
-                exit(1)
+            if report_id is not None and not done:
+                self.discard_report(mongo_db, mongo_collection, report_id)
+
+    def discard_report(self, mongo_db, mongo_collection, report_id):
+        """
+        Delete a report that could not be written completely: its instance documents, its summary and its header.
+        """
+        try:
+            db = self.conn[mongo_db]
+            deleted = db[instances_collection_name(mongo_collection)].delete_many({'report_id': report_id})
+            db[summary_collection_name(mongo_collection)].delete_one({'report_id': report_id})
+            db[mongo_collection].delete_one({'_id': report_id})
+            logger.warning("Report {} has been discarded with {} instances written".format(report_id,
+                                                                                          deleted.deleted_count))
+        except PyMongoError as e:
+            logger.error("Error to discard report {} - Mongodb {}".format(report_id, e))
+
+    def save_summary(self, mongo_db, mongo_collection, report_id, data):
+        """
+        Materialize the summary of the report (aggregation_details, money_details and the team/owner rollups) as
+        a single document of <mongo_collection>_summary, read by the summary and history endpoints instead of
+        the reports.
+        """
+        summary = dict((key, data.get(key)) for key in SUMMARY_KEYS)
+        summary['report_id'] = report_id
+        self.conn[mongo_db][summary_collection_name(mongo_collection)].replace_one({'report_id': report_id}, summary,
+                                                                                  upsert=True)
+        logger.debug("Summary of report {} has been saved".format(report_id))
+
+    def get_summary_history(self, mongo_db, mongo_collection, since=None, limit=None, details=False):
+        """
+        Time series of the summaries, the newest first, from since (report_date in ISO 8601) up to limit documents.
+        The team/owner rollups are only returned with details. The summaries of the reports still being written
+        are left out.
+        """
+        query = {}
+        if since is not None:
+            query['report_date'] = {'$gte': since}
+        projection = None if details else {'team_details': False, 'owner_details': False}
+        limit = int(config_fallback(limit, fallback=config_fallback(main_config['mongo_history_limit'],
+                                                                    fallback=90)))
+        try:
+            writing = [header['_id'] for header in self.conn[mongo_db][mongo_collection].find(
+                {'status': REPORT_STATUS_WRITING}, {'_id': True})]
+            if writing:
+                query['report_id'] = {'$nin': writing}
+            documents = self.conn[mongo_db][summary_collection_name(mongo_collection)].find(query, projection).sort(
+                "report_date", DESCENDING).limit(limit)
+            return [document for document in documents]
+        except PyMongoError as e:
+            logger.exception("Error on Mongo get_summary_history - {}".format(e), exc_info=True)
+
+    def get_latest_report_id(self, mongo_db, mongo_collection):
+        report = self.get_latest_report(mongo_db, mongo_collection, {'_id': True})
+        return report['_id'] if report is not None else None
+
+    def get_latest_report(self, mongo_db, mongo_collection, projection=None):
+        if projection is None:
+            projection = dict((field, False) for field in HEADER_REFERENCE_FIELDS)
+        documents = self.conn[mongo_db][mongo_collection].find(done_reports_filter(), projection).sort(
+            "report_date", DESCENDING).limit(1)
+        for document in documents:
+            return document
+        return None
+
+    def get_report_instances(self, mongo_db, mongo_collection, report_id, query=None,
+                             excluded_fields=INSTANCE_REFERENCE_FIELDS, limit=None):
+        instance_query = {'report_id': report_id}
+        instance_query.update(query or {})
+        documents = self.conn[mongo_db][instances_collection_name(mongo_collection)].find(
+            instance_query, dict((field, False) for field in excluded_fields))
+        if limit:
+            documents = documents.limit(int(limit))
+        return [document for document in documents]
 
     def get_low_utilizaion_db(self, mongo_db, mongo_collection, instance_id=None, instance_region=None, tag_key=None,
-                              tag_value=None, summary_report=None):
+                              tag_value=None, summary_report=None, tags=None, limit=None):
         try:
             db = self.conn[mongo_db][mongo_collection]
             documents = None
@@ -54,41 +343,62 @@ class Mongo(object):
 
             if summary_report:
                 try:
-                    documents = db.find({}, {"aggregation_details": 1, "money_details": 1}).sort("report_date",
-                                                                                                 -1).limit(1)
+                    # The summary of the latest done report, not the newest one, which may be of a report being
+                    # written.
+                    documents = []
+                    report_id = self.get_latest_report_id(mongo_db, mongo_collection)
+                    if report_id is not None:
+                        summary = self.conn[mongo_db][summary_collection_name(mongo_collection)].find_one(
+                            {'report_id': report_id})
+                        documents = [summary] if summary is not None else []
+                    if not documents:
+                        # Reports saved before the summary collection.
+                        documents = db.find(done_reports_filter(), {"aggregation_details": 1,
+                                                                    "money_details": 1}).sort("report_date",
+                                                                                              -1).limit(1)
                 except  Exception:
                     logger.exception("Error on summity", exc_info=True)
 
-            elif tag_key is not None and tag_value is not None:
-                documents = db.aggregate(
-                    [
-                        {"$sort": {"report_date": -1}},
-                        {
-                            "$project": {
-                                "low_utilization_instances": {
-                                    "$filter": {
-                                        "input": "$low_utilization_instances",
-                                        "as": "instance",
-                                        "cond": {"$eq": ["$$instance.instance_tags.{}".format(tag_key), tag_value]}
-                                    }
-                                }
-                            }
-                        }
-                    ]
-                )
+            elif tags or (tag_key is not None and tag_value is not None):
+                # Only the latest report is touched: its id first, then the matching instances through the indexes.
+                tags = dict((key, list(value) if isinstance(value, (list, tuple)) else [value])
+                            for key, value in (tags or {}).items())
+                if tag_key is not None and tag_value is not None:
+                    tags.setdefault(tag_key, []).append(tag_value)
+                # The limit is never unbounded: missing, zero or negative is mongo_query_limit, and it is capped there.
+                max_limit = int(config_fallback(main_config['mongo_query_limit'], fallback=1000))
+                limit = min(int(limit), max_limit) if limit is not None and int(limit) > 0 else max_limit
+                documents = []
+                report = self.get_latest_report(mongo_db, mongo_collection, {"report_date": 1})
+                if report is not None:
+                    query = tags_query(tags)
+                    query['low_utilization'] = True
+                    report[REPORT_LOW_UTILIZATION_KEY] = self.get_report_instances(mongo_db, mongo_collection,
+                                                                                   report['_id'], query, limit=limit)
+                    documents = [report]
 
             else:
-                documents = db.find().sort("_id", -1).limit(1)
+                documents = []
+                report = self.get_latest_report(mongo_db, mongo_collection)
+                if report is not None and REPORT_INSTANCES_KEY not in report:
+                    # Assemble the report back from its instance documents.
+                    query = {}
+                    if instance_id is not None:
+                        query['InstanceId'] = instance_id
+                    if instance_region is not None:
+                        query['InstanceRegion'] = instance_region
+                    instances = self.get_report_instances(mongo_db, mongo_collection, report['_id'], query,
+                                                          excluded_fields=['_id', 'report_id', 'report_date'])
+                    low_utilization_instances = []
+                    for instance in instances:
+                        if instance.pop('low_utilization', False):
+                            low_utilization_instances.append(instance)
+                    report[REPORT_LOW_UTILIZATION_KEY] = low_utilization_instances
+                    report[REPORT_INSTANCES_KEY] = instances
+                if report is not None:
+                    documents = [report]
 
             result = [(item) for item in documents]
             return result
         except Exception as e:
             logger.exception("Error on Mongo get_low_utilizaion_db - {}".format(e), exc_info=True)
-        finally:
-            try:
-                self.conn.close()
-                logger.debug("Connection with mongo has finished")
-                pass
-            except Exception as e:
-                logger.error("Error to finish MongoDB connection: {}".format(e))
-                exit(1)
@@ -28,10 +28,22 @@ class DataStore(object):
             logger.error("Fail on save this information: {}".format(data))
 
     def get_low_utilization_db(self, db, table, instance_id=None, instance_region=None, tag_key=None, tag_value=None,
-                               summary_report=None):
+                               summary_report=None, tags=None, limit=None):
         try:
             rs = self.mongo.get_low_utilizaion_db(db, table, instance_id, instance_region, tag_key, tag_value,
-                                                  summary_report)
+                                                  summary_report, tags, limit)
             return rs[0]
         except Exception as e:
             logger.error("Error on get data {}".format(e))
+
+    def get_latest_report_id_db(self, db, table):
+        try:
+            return self.mongo.get_latest_report_id(db, table)
+        except Exception as e:
+            logger.error("Error on get latest report id {}".format(e))
+
+    def get_summary_history_db(self, db, table, since=None, limit=None, details=False):
+        try:
+            return self.mongo.get_summary_history(db, table, since, limit, details)
+        except Exception as e:
+            logger.error("Error on get summary history {}".format(e))
@@ -0,0 +1,92 @@
+import logging
+import logging.config
+import math
+import warnings
+
+import numpy as np
+
+from api_config import log_config
+
+logging.config.dictConfig(log_config)
+logger = logging.getLogger("metrics_matrix")
+
+
+def epoch(dt):
+    # Naive datetimes are in the system timezone, like datetime.today().
+    return dt.timestamp()
+
+
+class MetricsMatrix(object):
+    """
+        MetricsMatrix class.
+        One NumPy matrix (instance x period) per metric, with NaN where CloudWatch has no datapoint,
+        so the statistics of all instances are computed at once, without python loops per row.
+    """
+
+    def __init__(self, instances_ids, metric_names, starttime, endtime, period=3600):
+        self.instances_ids = list(instances_ids)
+        self.rows_index = dict((instance_id, row) for row, instance_id in enumerate(self.instances_ids))
+        self.metric_names = list(metric_names)
+        self.period = period
+        self.start = epoch(starttime)
+        self.periods = max(int(math.ceil((epoch(endtime) - self.start) / period)), 1)
+        self.data = dict((metric_name, np.full((len(self.instances_ids), self.periods), np.nan, dtype=np.float32))
+                         for metric_name in metric_names)
+
+    def add_columns(self, instances_ids, metric_names, instances, metrics, timestamps, values):
+        """
+        Add many datapoints at once, given as columns (e.g. loaded from the MetricsStore) with the instances
+        and metrics as int codes of the instances_ids and metric_names tables, timestamps in epoch seconds.
+        """
+        if timestamps.size == 0:
+            return
+        rows = np.array([self.rows_index.get(str(instance_id), -1) for instance_id in instances_ids],
+                        dtype=np.int64)[instances]
+        columns = ((timestamps - self.start) // self.period).astype(int)
+        in_matrix = (rows >= 0) & (columns >= 0) & (columns < self.periods)
+        for code, metric_name in enumerate(metric_names):
+            if str(metric_name) not in self.data:
+                continue
+            valid = in_matrix & (metrics == code)
+            self.data[str(metric_name)][rows[valid], columns[valid]] = values[valid]
+
+    def clear(self, instance_id):
+        # Forget all datapoints of the instance, e.g. when its metrics could not be fetched.
+        for data in self.data.values():
+            data[self.rows_index[instance_id], :] = np.nan
+
+    def __window(self, metric_name, periods=None):
+        # The last periods columns, the whole matrix when periods is None.
+        if periods is None or periods >= self.periods:
+            return self.data[metric_name]
+        return self.data[metric_name][:, self.periods - int(periods):]
+
+    def has_data(self, metric_name, periods=None):
+        return ~np.all(np.isnan(self.__window(metric_name, periods)), axis=1)
+
+    def mean(self, metric_name, periods=None):
+        return self.__nan_stat(np.nanmean, metric_name, periods)
+
+    def max(self, metric_name, periods=None):
+        return self.__nan_stat(np.nanmax, metric_name, periods)
+
+    def percentile(self, metric_name, q, periods=None):
+        return self.__nan_stat(np.nanpercentile, metric_name, periods, q)
+
+    def fraction_below(self, metric_name, threshold, periods=None):
+        """
+        Fraction of the periods with datapoint where the metric is below threshold (e.g. idle hours of CPU).
+        """
+        window = self.__window(metric_name, periods)
+        with np.errstate(invalid='ignore'):
+            below = (window < threshold).sum(axis=1)
+        available = (~np.isnan(window)).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(available > 0, below / np.maximum(available, 1), np.nan)
+
+    def __nan_stat(self, function, metric_name, periods=None, *args):
+        window = self.__window(metric_name, periods)
+        with warnings.catch_warnings():
+            # Rows without any datapoint return NaN and numpy warns about it.
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            return function(window.astype(np.float64), *args, axis=1)
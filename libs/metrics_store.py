@@ -0,0 +1,243 @@
+import glob
+import logging
+import logging.config
+import os
+import threading
+import time
+
+import numpy as np
+
+from api_config import log_config, main_config
+from libs.tools import config_fallback
+
+logging.config.dictConfig(log_config)
+logger = logging.getLogger("metrics_store")
+
+# Rows of datapoints, instances and metrics are int codes of the instance_ids and metric_names tables.
+COLUMNS = ['instances', 'metrics', 'timestamps', 'values']
+TABLES = ['instance_ids', 'metric_names']
+
+
+def make_columns(instance_ids, metric_names, instances, metrics, timestamps, values):
+    return {'instance_ids': np.asarray(instance_ids, dtype=str), 'metric_names': np.asarray(metric_names, dtype=str),
+            'instances': np.asarray(instances, dtype=np.int32), 'metrics': np.asarray(metrics, dtype=np.int16),
+            'timestamps': np.asarray(timestamps, dtype=np.int64), 'values': np.asarray(values, dtype=np.float32)}
+
+
+def empty_columns(instance_ids=(), metric_names=()):
+    return make_columns(instance_ids, metric_names, [], [], [], [])
+
+
+def concat_columns(parts):
+    """
+    Concatenate the rows of parts with different tables, the codes are mapped to the union of the tables.
+    """
+    if not parts:
+        return empty_columns()
+    tables = dict((table, np.unique(np.concatenate([part[table] for part in parts]))) for table in TABLES)
+    instances = []
+    metrics = []
+    for part in parts:
+        instances.append(np.searchsorted(tables['instance_ids'], part['instance_ids']).astype(np.int32)[
+            part['instances']])
+        metrics.append(np.searchsorted(tables['metric_names'], part['metric_names']).astype(np.int16)[
+            part['metrics']])
+    return make_columns(tables['instance_ids'], tables['metric_names'], np.concatenate(instances),
+                        np.concatenate(metrics), np.concatenate([part['timestamps'] for part in parts]),
+                        np.concatenate([part['values'] for part in parts]))
+
+
+def select_rows(columns, mask):
+    selected = dict((column, columns[column][mask]) for column in COLUMNS)
+    selected.update((table, columns[table]) for table in TABLES)
+    return selected
+
+
+def instances_codes(columns, instances_ids):
+    # Codes of instances_ids in the instance_ids table of the columns, the unknown ones are ignored.
+    return np.flatnonzero(np.isin(columns['instance_ids'], list(instances_ids)))
+
+
+def prune_tables(columns):
+    # Drop the ids and names without rows, e.g. the instances terminated before the retention.
+    used_instances, instances = np.unique(columns['instances'], return_inverse=True)
+    used_metrics, metrics = np.unique(columns['metrics'], return_inverse=True)
+    return make_columns(columns['instance_ids'][used_instances], columns['metric_names'][used_metrics], instances,
+                        metrics, columns['timestamps'], columns['values'])
+
+
+def deduplicate(columns):
+    """
+    Keep one datapoint per (instance, metric, timestamp), the last one of the columns wins, sorted by
+    instance, metric and timestamp.
+    """
+    if columns['timestamps'].size == 0:
+        return columns
+    sequence = np.arange(columns['timestamps'].size)
+    order = np.lexsort((sequence, columns['timestamps'], columns['metrics'], columns['instances']))
+    instances = columns['instances'][order]
+    metrics = columns['metrics'][order]
+    timestamps = columns['timestamps'][order]
+    # The last row of each group is the newer one.
+    last = np.ones(order.size, dtype=bool)
+    last[:-1] = (instances[1:] != instances[:-1]) | (metrics[1:] != metrics[:-1]) | (
+        timestamps[1:] != timestamps[:-1])
+    return select_rows(columns, order[last])
+
+
+class MetricsStore(object):
+    """
+        MetricsStore class.
+        Local store of the raw CloudWatch datapoints, one directory per region. Each scan writes only the
+        datapoints it fetched as a new segment (a NumPy .npz file with the columns instance, metric, timestamp
+        and value, the instance and metric as int codes of small tables of ids and names), and compact() merges
+        the segments into the base file of the region, dropping the datapoints older than the retention.
+    """
+
+    def __init__(self, store_dir=None, retention_days=None, max_segments=None):
+        self.store_dir = config_fallback(store_dir, fallback=main_config['aws_metrics_store_dir'])
+        self.retention = int(config_fallback(retention_days, fallback=config_fallback(
+            main_config['aws_metrics_store_retention'], fallback=35))) * 86400
+        self.max_segments = int(config_fallback(max_segments, fallback=config_fallback(
+            main_config['aws_metrics_store_max_segments'], fallback=8)))
+        self.lock = threading.Lock()
+        self.region_locks = {}
+
+    @property
+    def enabled(self):
+        return self.store_dir is not None
+
+    def region_lock(self, region):
+        with self.lock:
+            if region not in self.region_locks:
+                self.region_locks[region] = threading.Lock()
+            return self.region_locks[region]
+
+    def __region_dir(self, region):
+        return os.path.join(self.store_dir, region)
+
+    def __base_file(self, region):
+        return os.path.join(self.__region_dir(region), 'base.npz')
+
+    def __segment_files(self, region):
+        return sorted(glob.glob(os.path.join(self.__region_dir(region), 'segment-*.npz')))
+
+    @staticmethod
+    def __read(file_name):
+        try:
+            with np.load(file_name) as data:
+                return dict((column, data[column]) for column in COLUMNS + TABLES)
+        except Exception as e:
+            logger.error("Error to read metrics store file {} - {}".format(file_name, e))
+            return empty_columns()
+
+    @staticmethod
+    def __write(file_name, columns):
+        # np.savez appends .npz to file names, so the temporary file is written through a file object.
+        tmp_file = "{}.tmp".format(file_name)
+        with open(tmp_file, 'wb') as f:
+            np.savez_compressed(f, **columns)
+        os.replace(tmp_file, file_name)
+
+    def __read_region(self, region):
+        parts = []
+        if os.path.isfile(self.__base_file(region)):
+            parts.append(self.__read(self.__base_file(region)))
+        parts.extend(self.__read(segment) for segment in self.__segment_files(region))
+        return concat_columns(parts)
+
+    def load(self, region, instances_ids, since=None):
+        """
+        Datapoints of instances_ids in the region, newer than since (epoch seconds) and the retention.
+
+        :return: dict of columns (instances, metrics, timestamps, values and the tables instance_ids and
+            metric_names), one datapoint per row.
+        """
+        if not self.enabled:
+            return empty_columns()
+        since = max(since or 0, time.time() - self.retention)
+        with self.region_lock(region):
+            columns = self.__read_region(region)
+        mask = (columns['timestamps'] >= since) & np.isin(columns['instances'], instances_codes(columns,
+                                                                                                instances_ids))
+        return deduplicate(select_rows(columns, mask))
+
+    @staticmethod
+    def timestamps_range(columns):
+        """
+        :return: dict {instance_id: (timestamp of the older datapoint, timestamp of the newer datapoint)} of any metric
+        """
+        ranges = {}
+        if columns['timestamps'].size == 0:
+            return ranges
+        older = np.full(columns['instance_ids'].size, np.iinfo(np.int64).max, dtype=np.int64)
+        newer = np.full(columns['instance_ids'].size, np.iinfo(np.int64).min, dtype=np.int64)
+        np.minimum.at(older, columns['instances'], columns['timestamps'])
+        np.maximum.at(newer, columns['instances'], columns['timestamps'])
+        for code in np.unique(columns['instances']):
+            ranges[str(columns['instance_ids'][code])] = (int(older[code]), int(newer[code]))
+        return ranges
+
+    def append(self, region, columns):
+        """
+        Save the datapoints fetched by a scan as a new segment of the region, compacting the region when it
+        has more than max_segments segments.
+        """
+        if not self.enabled or columns['timestamps'].size == 0:
+            return
+        with self.region_lock(region):
+            try:
+                os.makedirs(self.__region_dir(region), exist_ok=True)
+                segment_file = os.path.join(self.__region_dir(region), 'segment-{}.npz'.format(
+                    int(time.time() * 1000)))
+                self.__write(segment_file, columns)
+                logger.debug("Metrics store segment with {} datapoints saved to {}".format(
+                    columns['timestamps'].size, segment_file))
+            except Exception as e:
+                logger.error("Error to save metrics store segment of region {} - {}".format(region, e))
+                return
+            if len(self.__segment_files(region)) > self.max_segments:
+                self.__compact_region(region)
+
+    def compact(self, region=None):
+        """
+        Merge the segments into the base file, dropping duplicated and expired datapoints, of one or all regions.
+        """
+        if not self.enabled or not os.path.isdir(self.store_dir):
+            return
+        regions = [region] if region is not None else [name for name in os.listdir(self.store_dir)
+                                                       if os.path.isdir(os.path.join(self.store_dir, name))]
+        for name in regions:
+            with self.region_lock(name):
+                self.__compact_region(name)
+
+    def __compact_region(self, region):
+        segments = self.__segment_files(region)
+        try:
+            columns = self.__read_region(region)
+            before = columns['timestamps'].size
+            columns = select_rows(columns, columns['timestamps'] >= time.time() - self.retention)
+            columns = prune_tables(deduplicate(columns))
+            self.__write(self.__base_file(region), columns)
+            for segment in segments:
+                os.remove(segment)
+            logger.info("Metrics store of region {} compacted from {} to {} datapoints ({} segments)".format(
+                region, before, columns['timestamps'].size, len(segments)))
+        except Exception as e:
+            logger.error("Error to compact metrics store of region {} - {}".format(region, e))
+
+
+metrics_store = None
+metrics_store_lock = threading.Lock()
+
+
+def get_metrics_store():
+    """
+    Return the process-wide MetricsStore, its region locks must be shared by concurrent scans, which read and
+    write the same segment files.
+    """
+    global metrics_store
+    with metrics_store_lock:
+        if metrics_store is None:
+            metrics_store = MetricsStore()
+        return metrics_store
@@ -0,0 +1,96 @@
+import json
+import logging
+import logging.config
+import os
+import threading
+
+from api_config import log_config, main_config
+from libs.tools import config_fallback, get_timestp, save_json_file
+
+logging.config.dictConfig(log_config)
+logger = logging.getLogger("price_cache")
+
+
+class PriceCache(object):
+    """
+        PriceCache class.
+        Memoize the EC2 prices by (instance_type, region, tenancy, operating system, offer term) in memory
+        and in a JSON file, so a price is asked to the Pricing API only once per TTL.
+    """
+
+    def __init__(self, cache_file=None, ttl=None):
+        self.cache_file = config_fallback(cache_file, fallback=main_config['aws_price_cache_file'])
+        self.ttl = int(config_fallback(ttl, fallback=config_fallback(main_config['aws_price_cache_ttl'],
+                                                                     fallback=86400)))
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.prices = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.__load()
+
+    @staticmethod
+    def make_key(instance_type, instance_region, tenancy, operating_system, offer_term):
+        return "{}|{}|{}|{}|{}".format(instance_type, instance_region, tenancy, operating_system, offer_term)
+
+    def __load(self):
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                self.prices = json.load(f)
+            logger.debug("Price cache loaded with {} entries from {}".format(len(self.prices), self.cache_file))
+        except Exception as e:
+            logger.error("Error to load price cache file {} - {}".format(self.cache_file, e))
+            self.prices = {}
+
+    def __persist(self):
+        if self.cache_file is None:
+            return
+        try:
+            save_json_file(self.cache_file, self.prices)
+        except Exception as e:
+            logger.error("Error to save price cache file {} - {}".format(self.cache_file, e))
+
+    def key_lock(self, key):
+        with self.lock:
+            if key not in self.key_locks:
+                self.key_locks[key] = threading.Lock()
+            return self.key_locks[key]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.prices.get(key)
+            if entry is not None and get_timestp() - entry['timestamp'] > self.ttl:
+                del self.prices[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(entry['price'])
+
+    def set(self, key, price):
+        with self.lock:
+            self.prices[key] = {'timestamp': get_timestp(), 'price': price}
+            self.__persist()
+
+    def stats(self):
+        return {'entries': len(self.prices), 'hits': self.hits, 'misses': self.misses, 'expired': self.expired}
+
+
+price_cache = None
+price_cache_lock = threading.Lock()
+
+
+def get_price_cache():
+    """
+    Return the process-wide PriceCache, so the prices looked up by one scan are reused by the next ones.
+    """
+    global price_cache
+    with price_cache_lock:
+        if price_cache is None:
+            price_cache = PriceCache()
+        return price_cache
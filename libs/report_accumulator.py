@@ -0,0 +1,88 @@
+import logging
+import logging.config
+import numbers
+import threading
+
+import pandas as pd
+
+from api_config import log_config
+
+logging.config.dictConfig(log_config)
+logger = logging.getLogger("report_accumulator")
+
+
+class ReportAccumulator(object):
+    """
+        ReportAccumulator class.
+        Append-only columns (one list per report key) filled with the reports of the scan, with the rows indexed by
+        key_column so they can be updated later. to_dataframe() builds one DataFrame at the end, with
+        numeric dtypes for the columns that only have numbers (but integers with None), instead of one pd.concat
+        per instance.
+    """
+
+    def __init__(self, key_column='InstanceId'):
+        self.key_column = key_column
+        self.columns = {}
+        self.rows_index = {}
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.rows
+
+    def append(self, record):
+        with self.lock:
+            for column in record:
+                if column not in self.columns:
+                    # New column, the rows before it have no value.
+                    self.columns[column] = [None] * self.rows
+            for column, values in self.columns.items():
+                values.append(record.get(column))
+            self.rows_index[record.get(self.key_column)] = self.rows
+            self.rows += 1
+
+    def update(self, key, fields):
+        with self.lock:
+            row = self.rows_index[key]
+            for column, value in fields.items():
+                if column not in self.columns:
+                    self.columns[column] = [None] * self.rows
+                self.columns[column][row] = value
+
+    def records(self, columns):
+        """
+        Generator of dicts with only the given columns of each row.
+        """
+        with self.lock:
+            selected = dict((column, list(self.columns.get(column, [None] * self.rows))) for column in columns)
+            rows = self.rows
+        for row in range(rows):
+            yield dict((column, values[row]) for column, values in selected.items())
+
+    @staticmethod
+    def __is_numeric(values):
+        has_number = False
+        for value in values:
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, numbers.Number):
+                return False
+            has_number = True
+        return has_number
+
+    @staticmethod
+    def __is_integer_with_none(values):
+        # Integers with None would become float64 with NaN, so they are kept as python objects.
+        return None in values and all(isinstance(value, numbers.Integral) for value in values if value is not None)
+
+    def to_dataframe(self):
+        with self.lock:
+            data = {}
+            for column, values in self.columns.items():
+                if self.__is_numeric(values) and not self.__is_integer_with_none(values):
+                    data[column] = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce')
+                else:
+                    data[column] = pd.Series(values, dtype=object)
+            df = pd.DataFrame(data, columns=list(self.columns.keys()))
+        logger.debug("DataFrame of {} rows and {} columns has been built".format(df.shape[0], df.shape[1]))
+        return df
@@ -0,0 +1,79 @@
+import logging
+import logging.config
+
+import numpy as np
+import pandas as pd
+
+from api_config import log_config
+from libs.tools import expand_tags
+
+logging.config.dictConfig(log_config)
+logger = logging.getLogger("report_summary")
+
+COST_COLUMNS = ['cost_month_ondemand', 'cost_month_reserved', 'save_money_month']
+UNTAGGED = 'untagged'
+
+
+def _flags_sum(totals, column, reserved=None, low=None):
+    rows = totals
+    if reserved is not None:
+        rows = rows[rows['reserved'] == reserved]
+    if low is not None:
+        rows = rows[rows['low'] == low]
+    return rows[column].sum()
+
+
+def summarize_instances(df, df_low, tag_keys=('team', 'owner'), untagged_keys=('owner', 'team', 'work')):
+    """
+    Summarize the instances of a report in one grouped pass: instances and costs split by reserved/on demand
+    and low utilization, the untagged counts of untagged_keys, plus the same numbers per value of each tag
+    in tag_keys.
+
+    :return: dict with the totals, untagged_<tag> counts and, in by_<tag>, a list of dicts per tag value.
+    """
+    reserved = np.zeros(df.shape[0], dtype=bool)
+    if 'instance_reservation_id' in df:
+        reserved = df['instance_reservation_id'].notnull().values
+    low = np.zeros(df.shape[0], dtype=bool)
+    if 'InstanceId' in df:
+        low = df['InstanceId'].isin(df_low['InstanceId']).values
+
+    frame = df.reindex(columns=COST_COLUMNS).apply(pd.to_numeric, errors='coerce').fillna(0.0)
+    frame['instances'] = 1
+    frame['reserved'] = reserved
+    frame['low'] = low
+    # What each instance costs today, reserved price if it has a reservation, otherwise on demand price.
+    frame['cost_month'] = frame['cost_month_reserved'].where(frame['reserved'], frame['cost_month_ondemand'])
+    frame['cost_month_low_utilization'] = frame['cost_month'].where(frame['low'], 0.0)
+
+    totals = frame.groupby(['reserved', 'low']).sum().reset_index()
+    summary = {
+        'total_instances': int(frame.shape[0]),
+        'total_instances_reserved': int(_flags_sum(totals, 'instances', reserved=True)),
+        'total_instances_on_demand': int(_flags_sum(totals, 'instances', reserved=False)),
+        'total_cost_reserved': float(_flags_sum(totals, 'cost_month_reserved', reserved=True)),
+        'total_cost_on_demand': float(_flags_sum(totals, 'cost_month_ondemand', reserved=False)),
+        'total_cost_low_utilization_ri': float(_flags_sum(totals, 'cost_month_reserved', reserved=True, low=True)),
+        'total_cost_low_utilization_od': float(_flags_sum(totals, 'cost_month_ondemand', reserved=False, low=True)),
+        'total_cost_simulated_ri': float(_flags_sum(totals, 'cost_month_reserved', reserved=False)),
+        'ri_potential_save': float(_flags_sum(totals, 'save_money_month', reserved=False)),
+    }
+
+    # The tags are expanded into columns only once, for the untagged counts and the per tag breakdown.
+    all_tag_keys = list(tag_keys) + [tag for tag in untagged_keys if tag not in tag_keys]
+    tags = expand_tags(df['instance_tags'] if 'instance_tags' in df else pd.Series([{}] * df.shape[0]),
+                       all_tag_keys)
+    untagged = tags.isnull().sum()
+    for tag in untagged_keys:
+        summary['untagged_{}'.format(tag)] = int(untagged[tag])
+
+    # Per tag breakdown
+    by_tag = frame[['instances', 'cost_month', 'cost_month_low_utilization']].copy()
+    by_tag['low_utilization'] = frame['low'].astype(int)
+    for tag in tag_keys:
+        # The tag values are kept in the records, not as keys, because MongoDB keys cannot have dots.
+        grouped = by_tag.groupby(tags[tag].fillna(UNTAGGED).values).sum().round(2)
+        grouped.index.name = tag
+        summary['by_{}'.format(tag)] = grouped.reset_index().sort_values('cost_month', ascending=False).to_dict(
+            orient='records')
+    return summary
@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import logging.config
+import threading
+from collections import OrderedDict
+
+from api_config import log_config, main_config
+from libs.tools import config_fallback
+
+logging.config.dictConfig(log_config)
+logger = logging.getLogger("response_cache")
+
+
+class ResponseCache(object):
+    """
+        ResponseCache class.
+        LRU of serialized API responses, keyed by report id plus endpoint and query parameters, bounded by the
+        total size of the bodies and by the number of entries. The reports only change once per scan, so a
+        response is serialized once and served from memory until the next report is saved. Each entry keeps the
+        ETag of its body, computed when the body is built.
+    """
+
+    def __init__(self, max_bytes=None, max_entries=None):
+        self.max_bytes = int(config_fallback(max_bytes, fallback=config_fallback(
+            main_config['api_response_cache_max_bytes'], fallback=256 * 1024 ** 2)))
+        self.max_entries = int(config_fallback(max_entries, fallback=config_fallback(
+            main_config['api_response_cache_max_entries'], fallback=128)))
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(report_id, endpoint, params):
+        return "{}|{}|{}".format(report_id, endpoint, sorted(params))
+
+    @staticmethod
+    def make_etag(body):
+        # From the body itself, so a client never keeps a body that is not the one served now.
+        return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        :return: tuple (body, etag) or None when the response is not cached.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, body, etag):
+        if len(body) > self.max_bytes:
+            logger.debug("Response of {} bytes is bigger than the cache, not cached".format(len(body)))
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[0])
+            self.entries[key] = (body, etag)
+            self.size += len(body)
+            while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        logger.debug("Response cache has been invalidated")
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Return the process-wide ResponseCache, shared by all requests and invalidated when a report is saved.
+    """
+    global response_cache
+    with response_cache_lock:
+        if response_cache is None:
+            response_cache = ResponseCache()
+        return response_cache
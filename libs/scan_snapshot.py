@@ -0,0 +1,96 @@
+import json
+import logging
+import logging.config
+import os
+import threading
+
+from api_config import log_config, main_config
+from libs.tools import config_fallback, get_timestp, datetime_iso8601, save_json_file
+
+logging.config.dictConfig(log_config)
+logger = logging.getLogger("scan_snapshot")
+
+
+def instance_fingerprint(instance, asg_name=None):
+    """
+    Fingerprint of what the static details of an instance (prices, reservation, tags, SSH access...) depend on,
+    from its describe_instances record. Any difference means the instance must be processed from scratch.
+    """
+    tags = sorted((tag['Key'], tag['Value']) for tag in instance.get('Tags', []))
+    launchtime = instance.get('LaunchTime')
+    return json.dumps([instance.get('InstanceType'), instance.get('ImageId'), instance.get('KeyName'),
+                       instance.get('PrivateIpAddress'), instance.get('State', {}).get('Code'),
+                       instance.get('Placement', {}).get('AvailabilityZone'),
+                       instance.get('Placement', {}).get('Tenancy'),
+                       datetime_iso8601(launchtime) if launchtime is not None else None,
+                       asg_name, tags])
+
+
+class ScanSnapshot(object):
+    """
+        ScanSnapshot class.
+        The static details and the SSH memory info of each instance of the last full scan, with the fingerprint
+        of its describe_instances record, saved in a JSON file. The next scan carries them forward for the
+        unchanged instances, so only the new and changed ones are processed from scratch.
+    """
+
+    def __init__(self, snapshot_file=None, max_age=None):
+        self.snapshot_file = config_fallback(snapshot_file, fallback=main_config['system_scan_snapshot_file'])
+        self.max_age = int(config_fallback(max_age, fallback=config_fallback(
+            main_config['system_scan_snapshot_max_age'], fallback=604800)))
+        self.instances = {}
+        self.lock = threading.Lock()
+        self.__load()
+
+    def __load(self):
+        if self.snapshot_file is None or not os.path.isfile(self.snapshot_file):
+            return
+        try:
+            with open(self.snapshot_file, 'r') as f:
+                self.instances = json.load(f)
+            logger.debug("Scan snapshot loaded with {} instances from {}".format(len(self.instances),
+                                                                               self.snapshot_file))
+        except Exception as e:
+            logger.error("Error to load scan snapshot file {} - {}".format(self.snapshot_file, e))
+            self.instances = {}
+
+    def get(self, instance_id, fingerprint):
+        """
+        :return: the snapshot entry of instance_id ({'details': ..., 'memory': ..., ...}) or None if the instance
+            is new, changed or its details are older than max_age.
+        """
+        with self.lock:
+            entry = self.instances.get(instance_id)
+        if entry is None or entry['fingerprint'] != fingerprint or get_timestp() - entry['timestamp'] > self.max_age:
+            return None
+        return entry
+
+    def replace(self, entries):
+        """
+        Replace the snapshot by the instances of the last scan and save it, entries is {instance_id: entry}.
+        """
+        with self.lock:
+            self.instances = entries
+            if self.snapshot_file is None:
+                return
+            try:
+                save_json_file(self.snapshot_file, self.instances)
+                logger.debug("Scan snapshot with {} instances saved to {}".format(len(entries), self.snapshot_file))
+            except Exception as e:
+                logger.error("Error to save scan snapshot file {} - {}".format(self.snapshot_file, e))
+
+
+scan_snapshot = None
+scan_snapshot_lock = threading.Lock()
+
+
+def get_scan_snapshot():
+    """
+    Return the process-wide ScanSnapshot, the snapshot file is read once and its lock serializes the replace() of
+    concurrent scans.
+    """
+    global scan_snapshot
+    with scan_snapshot_lock:
+        if scan_snapshot is None:
+            scan_snapshot = ScanSnapshot()
+        return scan_snapshot
@@ -0,0 +1,182 @@
+import json
+import logging
+import logging.config
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import paramiko
+
+from api_config import log_config, main_config
+from libs.tools import config_fallback, default_mem_info, ssh_os_linux_available_memory, get_timestp, \
+    save_json_file, ssh_failure_names
+
+logging.config.dictConfig(log_config)
+logger = logging.getLogger("ssh_probe")
+
+# Outcome of the probe of each host of a batch
+PROBE_DONE = 'probed'
+PROBE_FAILED = 'probe failed'
+PROBE_SKIPPED = 'skipped, failed recently'
+PROBE_DEADLINE = 'overall deadline reached'
+
+
+class SSHCredentialCache(object):
+    """
+        SSHCredentialCache class.
+        Remember the username that worked by (AMI, key name), keep the parsed private keys in memory and
+        keep a negative cache, with expiry, of hosts and keys known to fail. Usernames and failures are
+        saved in a JSON file, so the next scan goes straight to the right login.
+    """
+
+    def __init__(self, cache_file=None, negative_ttl=None):
+        self.cache_file = config_fallback(cache_file, fallback=main_config['system_ssh_credential_cache_file'])
+        self.negative_ttl = int(config_fallback(negative_ttl, fallback=config_fallback(
+            main_config['system_ssh_negative_ttl'], fallback=21600)))
+        self.usernames = {}
+        self.failures = {}
+        self.private_keys = {}
+        self.lock = threading.Lock()
+        self.__load()
+
+    def __load(self):
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                data = json.load(f)
+            self.usernames = data.get('usernames', {})
+            self.failures = data.get('failures', {})
+            logger.debug("SSH credential cache loaded with {} usernames and {} failures from {}".format(
+                len(self.usernames), len(self.failures), self.cache_file))
+        except Exception as e:
+            logger.error("Error to load SSH credential cache file {} - {}".format(self.cache_file, e))
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        with self.lock:
+            now = get_timestp()
+            self.failures = dict((key, timestamp) for key, timestamp in self.failures.items()
+                                 if now - timestamp <= self.negative_ttl)
+            data = {'usernames': self.usernames, 'failures': self.failures}
+            try:
+                save_json_file(self.cache_file, data)
+            except Exception as e:
+                logger.error("Error to save SSH credential cache file {} - {}".format(self.cache_file, e))
+
+    @staticmethod
+    def __username_key(image_id, key_name):
+        return "{}|{}".format(image_id, key_name)
+
+    def get_username(self, image_id, key_name):
+        with self.lock:
+            return self.usernames.get(self.__username_key(image_id, key_name))
+
+    def set_username(self, image_id, key_name, username):
+        with self.lock:
+            self.usernames[self.__username_key(image_id, key_name)] = username
+
+    def get_private_key(self, key_path):
+        """
+        Return the paramiko.RSAKey of key_path, parsing the file only the first time.
+        """
+        with self.lock:
+            pkey = self.private_keys.get(key_path)
+        if pkey is None:
+            pkey = paramiko.RSAKey.from_private_key_file(key_path)
+            with self.lock:
+                self.private_keys[key_path] = pkey
+        return pkey
+
+    def is_failing(self, key):
+        with self.lock:
+            timestamp = self.failures.get(key)
+            if timestamp is None:
+                return False
+            if get_timestp() - timestamp > self.negative_ttl:
+                del self.failures[key]
+                return False
+            return True
+
+    def set_failure(self, key):
+        with self.lock:
+            self.failures[key] = get_timestp()
+
+
+credential_cache = None
+credential_cache_lock = threading.Lock()
+
+
+def get_credential_cache():
+    """
+    Return the process-wide SSHCredentialCache, the usernames, parsed keys and failures learned by the SSH probes
+    of one scan are used by the next ones.
+    """
+    global credential_cache
+    with credential_cache_lock:
+        if credential_cache is None:
+            credential_cache = SSHCredentialCache()
+        return credential_cache
+
+
+def _probe_host(host, host_deadline, overall_deadline, cache):
+    if any(cache.is_failing(name) for name in ssh_failure_names(host['host_ip'], host['host_key'])[1:]):
+        return PROBE_SKIPPED, default_mem_info()
+    deadline = min(time.monotonic() + host_deadline, overall_deadline)
+    dict_mem_info = ssh_os_linux_available_memory(host['host_ip'], host['host_key'], deadline=deadline,
+                                                  credential_cache=cache, image_id=host.get('image_id'))
+    # The default -1 means the host could not be reached, authenticated or did not answer in time.
+    return PROBE_DONE if dict_mem_info['percent_free'] != -1 else PROBE_FAILED, dict_mem_info
+
+
+def ssh_memory_probe_batch(hosts, max_workers=None, host_deadline=None, overall_deadline=None):
+    """
+    Fan out ssh_os_linux_available_memory() to many hosts at once, with bounded concurrency,
+    a deadline per host and an overall deadline for the whole batch.
+
+    :param list hosts: list of dict with the keys id, host_ip, host_key and image_id
+    :param int max_workers: max hosts probed at the same time (system_ssh_workers)
+    :param int host_deadline: seconds to probe one host, for all usernames (system_ssh_host_deadline)
+    :param int overall_deadline: seconds to probe the whole batch (system_ssh_overall_deadline)
+
+    :return:
+        a dict {id: (status, dict_mem_full_info)}, status is one of the PROBE_* outcomes, the hosts not probed
+        keep the default values.
+    """
+    max_workers = int(config_fallback(max_workers, fallback=config_fallback(main_config['system_ssh_workers'],
+                                                                            fallback=100)))
+    host_deadline = float(config_fallback(host_deadline, fallback=config_fallback(
+        main_config['system_ssh_host_deadline'], fallback=15)))
+    overall_deadline = float(config_fallback(overall_deadline, fallback=config_fallback(
+        main_config['system_ssh_overall_deadline'], fallback=600)))
+
+    results = dict((host['id'], (PROBE_DEADLINE, default_mem_info())) for host in hosts)
+    if not hosts:
+        return results
+
+    starttime = time.monotonic()
+    deadline = starttime + overall_deadline
+    cache = get_credential_cache()
+    executor = ThreadPoolExecutor(max_workers=max(min(max_workers, len(hosts)), 1))
+    futures = dict((executor.submit(_probe_host, host, host_deadline, deadline, cache), host) for host in hosts)
+    done, not_done = wait(futures, timeout=overall_deadline)
+    for future in done:
+        host = futures[future]
+        try:
+            results[host['id']] = future.result()
+        except Exception:
+            results[host['id']] = (PROBE_FAILED, default_mem_info())
+            logger.exception("Error on getting memory info of {}:{}".format(host['id'], host['host_ip']),
+                             exc_info=True)
+    for future in not_done:
+        future.cancel()
+        logger.warning("Overall deadline reached before getting memory info of {}".format(futures[future]['id']))
+    # The running probes stop by themselves at their own deadline.
+    executor.shutdown(wait=False)
+    cache.save()
+
+    logger.info("Memory info of {} hosts ({} done) collected through SSH in {:.2f}s".format(
+        len(hosts), len(done), time.monotonic() - starttime))
+    return results
@@ -1,10 +1,14 @@
 import datetime
+import json
 import logging
 import logging.config
 import math
+import os
 import re
 import socket
+import threading
 import time
+from contextlib import contextmanager
 from datetime import datetime
 from functools import wraps
 from pathlib import Path
@@ -177,16 +181,29 @@ def nan2floatzero(value):
         logger.error("Error to convert NaN value to 0.00 - {}".format(e))
 
 
+def round_or_none(value, ndigits=2):
+    # Missing metrics (NaN or None) stay None in the reports, they must not look like an idle instance.
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return round(float(value), ndigits)
+
+
 def findNumber(text):
     return (re.findall(r'\d+', text))[0]
 
 
-def sshCommand(command, hostname, username, tcpport=22, password=None, pkey=None):
+def sshCommand(command, hostname, username, tcpport=22, password=None, pkey=None, timeout=None, raise_errors=False):
+    """
+    :param pkey: path of the private key file or a paramiko.PKey already parsed.
+    :param bool raise_errors: raise the connection/authentication errors instead of log them and return None.
+    """
     ssh_timeout = 1
     try:
         ssh_timeout = config_fallback(main_config['system_ssh_timeout'], fallback=ssh_timeout)
     except Exception:
         pass
+    if timeout is not None:
+        ssh_timeout = min(ssh_timeout, timeout)
 
     kword = {}
     kword['hostname'] = hostname
@@ -196,9 +213,13 @@ def sshCommand(command, hostname, username, tcpport=22, password=None, pkey=None
     if password is not None:
         kword['password'] = password
     if pkey is not None:
-        kword['pkey'] = paramiko.RSAKey.from_private_key_file(pkey)
+        if isinstance(pkey, paramiko.PKey):
+            kword['pkey'] = pkey
+        else:
+            kword['pkey'] = paramiko.RSAKey.from_private_key_file(pkey)
     kword['compress'] = False
     fulloutput = None
+    ssh = None
     try:
         ssh = paramiko.SSHClient()
         ssh.load_system_host_keys()
@@ -212,9 +233,12 @@ def sshCommand(command, hostname, username, tcpport=22, password=None, pkey=None
             fulloutput += line
         return fulloutput
     except (socket.error, paramiko.AuthenticationException, paramiko.SSHException, Exception) as authe:
+        if raise_errors:
+            raise
         logger.warning("Error to user {}, ssh_key {}, {}".format(username, pkey, authe))
     finally:
-        ssh.close()
+        if ssh is not None:
+            ssh.close()
 
 
 """
@@ -289,6 +313,14 @@ def check_file_permission(file):
     return oct_perm
 
 
+def save_json_file(file, data):
+    # Write to a temporary file and rename it, so a crash never leaves a truncated file to the next load.
+    tmp_file = "{}.tmp".format(file)
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_file, file)
+
+
 def convert_dict_dataframe(dict):
     columns = list(dict.keys())
     values = list(dict.values())
@@ -320,18 +352,71 @@ def get_timestp():
     return timestamp
 
 
-def ssh_os_linux_available_memory(host_ip, host_key=None, username=None, password=None):
+def default_mem_info():
+    return {'percent_free': -1,
+            'memtotal': -1,
+            'memavailable': -1,
+            'kernel': 'unknown',
+            'distro': 'unknown'
+            }
+
+
+"""
+All information needed by calc_available_percent_memory() in a single SSH command, in "Key: value" lines:
+the sum of the zones low watermark (in pages), the /proc/meminfo fields, nr_mapped, kernel and distro.
+"""
+MEMORY_PROBE_COMMAND = "echo \"LowWatermark: $(awk '$1 == \"low\" {sum += $2} END {print sum}' /proc/zoneinfo)\"; " \
+                       "grep -E '^(Mem|Mapped:|Active\\(file\\)|Inactive\\(file\\)|SReclaimable)' /proc/meminfo; " \
+                       "grep nr_mapped /proc/vmstat; " \
+                       "echo \"Kernel: $(uname -r)\"; " \
+                       "echo \"Distro: $(head -1 /etc/issue)\""
+
+
+def parse_memory_probe(output, pagesize=4096):
+    # Single pass over the MEMORY_PROBE_COMMAND output, converting the "Key: value" lines in python key/value.
+    dict_ssh_return = {}
+    for line in output.split('\n'):
+        fields = line.strip().split()
+        if len(fields) < 2:
+            continue
+        dict_ssh_return[fields[0].replace(':', '').lower()] = fields[1]
+    dict_ssh_return['low_watermark'] = int(dict_ssh_return.pop('lowwatermark', 0)) * pagesize
+    return dict_ssh_return
+
+
+def ssh_failure_names(host_ip, host_key=None):
+    """
+    Names of the failures of a host in the SSHCredentialCache, built from the key name normalised to <name>.pem,
+    so the same ones are checked and set.
+
+    :return: tuple (host_key, host_failure, auth_failure, key_failure)
+    """
+    if host_key is not None and not ".pem" in host_key:
+        host_key += ".pem"
+    return host_key, "host:{}".format(host_ip), "auth:{}:{}".format(host_ip, host_key), "key:{}".format(host_key)
+
+
+def ssh_os_linux_available_memory(host_ip, host_key=None, username=None, password=None, deadline=None,
+                                  credential_cache=None, image_id=None):
+    """
+    Open one SSH session in the host and run MEMORY_PROBE_COMMAND. The private key is parsed once for all usernames,
+    the next username is only tried on authentication failure.
+
+    :param float deadline: time.monotonic() limit to finish the probe of this host, None to use only the ssh timeout.
+    :param credential_cache: SSHCredentialCache with the usernames by (image_id, host_key), the parsed keys and the
+        hosts/keys known to fail.
+    """
     kword = {}
-    dict_mem_full_info = {'percent_free': -1,
-                          'memtotal': -1,
-                          'memavailable': -1,
-                          'kernel': 'unknown',
-                          'distro': 'unknown'
-                          }
+    dict_mem_full_info = default_mem_info()
+
+    host_key, host_failure, auth_failure, key_failure = ssh_failure_names(host_ip, host_key)
+    if credential_cache is not None:
+        if credential_cache.is_failing(host_failure) or credential_cache.is_failing(auth_failure) or \
+                credential_cache.is_failing(key_failure):
+            logger.debug("Skipping host {} with key {}, it has failed recently".format(host_ip, host_key))
+            return dict_mem_full_info
 
     if host_key is not None:
-        if not ".pem" in host_key:
-            host_key += ".pem"
         key_path = main_config['aws_ssh_key_folder']
         if key_path[:1] == '/':
             key_path += "{}".format(host_key)
@@ -341,7 +426,16 @@ def ssh_os_linux_available_memory(host_ip, host_key=None, username=None, passwor
             logger.warning(
                 "Error of file not found {} in folder {}".format(host_key, main_config['aws_ssh_key_folder']))
             return dict_mem_full_info
-        kword['pkey'] = key_path
+        try:
+            if credential_cache is not None:
+                kword['pkey'] = credential_cache.get_private_key(key_path)
+            else:
+                kword['pkey'] = paramiko.RSAKey.from_private_key_file(key_path)
+        except Exception as e:
+            logger.warning("Error to load ssh key {} - {}".format(key_path, e))
+            if credential_cache is not None:
+                credential_cache.set_failure(key_failure)
+            return dict_mem_full_info
     elif password is not None:
         kword['password'] = password
     else:
@@ -349,67 +443,62 @@ def ssh_os_linux_available_memory(host_ip, host_key=None, username=None, passwor
 
     if username is None:
         os_usernames = ['ec2-user', 'centos', 'ubuntu', 'root']
+        cached_username = None
+        if credential_cache is not None:
+            cached_username = credential_cache.get_username(image_id, host_key)
+        if cached_username is not None:
+            os_usernames = [cached_username] + [user for user in os_usernames if user != cached_username]
     else:
         os_usernames = [username]
 
+    authenticated = False
+    kword['hostname'] = host_ip
+    kword['command'] = MEMORY_PROBE_COMMAND
     for username in os_usernames:
         logger.debug("Getting memory info through SSH")
-        low_watermark = 0
-        PAGESIZE = 4096
-        dict_ssh_return = {}
+        if deadline is not None:
+            kword['timeout'] = deadline - time.monotonic()
+            if kword['timeout'] <= 0:
+                logger.warning("Deadline reached on getting memory info of host {}".format(host_ip))
+                break
+        kword['username'] = username
         try:
-            kword['username'] = username
-            kword['hostname'] = host_ip
-
-            # First command...
-            kword['command'] = "cat /proc/zoneinfo| grep low| awk '{print $2}'"
-            result_commands = sshCommand(**kword)
-            if not result_commands:
-                return dict_mem_full_info
-            for line in result_commands.split('\n'):
-                if line == "":
-                    break
-                low_watermark += (int(line) * PAGESIZE)  # or sum(line) * 12k
-            dict_ssh_return['low_watermark'] = low_watermark
-
-            # Getting the rest os informations...
-            kword['command'] = "cat /proc/meminfo | grep Mem ;" \
-                               "cat /proc/meminfo | grep -w \"Mapped\"; " \
-                               "cat /proc/vmstat  | grep nr_mapped ;  " \
-                               "cat /proc/meminfo | grep \"Active(file)\" ;  " \
-                               "cat /proc/meminfo | grep \"Inactive(file)\"; " \
-                               "cat /proc/meminfo | grep \"SReclaimable\" ; " \
-                               "echo \"Kernel: $(uname -r)\"; " \
-                               "echo \"Distro: $(cat /etc/issue|head -1)\" "
-
-            # The above commands returns in Key/Value format, so we need to convert in python key/value
-            result_commands = sshCommand(**kword)
-            for line in result_commands.split('\n'):
-                if line == "":
-                    break
-                key = str(line.strip().split()[0]).replace(':', '')
-                value = str(line.strip().split()[1])
-                dict_ssh_return[key.lower()] = value
+            result_commands = sshCommand(raise_errors=True, **kword)
+        except paramiko.AuthenticationException:
+            logger.debug("Authentication failed to user {} on host {}".format(username, host_ip))
+            continue
+        except Exception as e:
+            # The host is unreachable, so there is no reason to try the others usernames.
+            logger.warning("Error on getting memory info through SSH of host {} - {}".format(host_ip, e))
+            if credential_cache is not None:
+                credential_cache.set_failure(host_failure)
+            return dict_mem_full_info
 
+        authenticated = True
+        if credential_cache is not None:
+            credential_cache.set_username(image_id, host_key, username)
+        try:
             # Now. we need to convert this information in data...
-            dict_mem_full_info['percent_free'] = calc_available_percent_memory(dict_ssh_return)[0]
-            dict_mem_full_info['memavailable'] = calc_available_percent_memory(dict_ssh_return)[1]
+            dict_ssh_return = parse_memory_probe(result_commands)
+            percent_free, memavailable = calc_available_percent_memory(dict_ssh_return)
+            dict_mem_full_info['percent_free'] = percent_free
+            dict_mem_full_info['memavailable'] = memavailable
             dict_mem_full_info['memtotal'] = dict_ssh_return['memtotal']
             dict_mem_full_info['kernel'] = dict_ssh_return['kernel']
             dict_mem_full_info['distro'] = dict_ssh_return['distro']
-
-            # Case success, break the "user" loop.
-            if dict_mem_full_info['percent_free'] is not None:
-                break
         except Exception:
             dict_mem_full_info['percent_free'] = 0.00
             dict_mem_full_info['memavailable'] = 0.00
             dict_mem_full_info['memtotal'] = 0.00
             dict_mem_full_info['kernel'] = None
             dict_mem_full_info['distro'] = None
-            logger.exception("Error on Getting memory info throughSSH: {}".format(kword), exc_info=False)
-        finally:
-            return dict_mem_full_info
+            logger.exception("Error on Getting memory info throughSSH: {}@{}".format(username, host_ip),
+                             exc_info=False)
+        break
+
+    if not authenticated and credential_cache is not None and (deadline is None or time.monotonic() < deadline):
+        credential_cache.set_failure(auth_failure)
+    return dict_mem_full_info
 
 
 def df_to_picke(df, file):
@@ -419,6 +508,11 @@ def df_to_picke(df, file):
         logger.error("Error to save dataframe to pickle file {} - {}".format(file, e))
 
 
+def df_to_records(df):
+    # The missing values are NaN in the numeric columns, the records have None instead (null in JSON and MongoDB).
+    return df.astype(object).where(df.notnull(), None).to_dict(orient='records')
+
+
 def picke_to_dataframe(file):
     if check_is_file_exist(file):
         try:
@@ -470,36 +564,42 @@ def is_valid(value):
         return False
 
 
-def count_tags(serie):
-    dict_count = {'untagged_owner': 0,
-                  'untagged_owner': 0,
-                  'untagged_team': 0,
-                  'untagged_work': 0
-                  }
-
-    untagged_owner = 0
-    untagged_team = 0
-    untagged_work = 0
-    try:
-        for row in serie:
-            try:
-                if not is_valid(row['owner']):
-                    untagged_owner += 1
-            except Exception:
-                pass
-            try:
-                if not is_valid(row['team']):
-                    untagged_team += 1
-            except Exception:
-                pass
-            try:
-                if not is_valid(row['work']):
-                    untagged_work += 1
-            except Exception:
-                pass
-        dict_count.update(
-            {'untagged_owner': untagged_owner, 'untagged_team': untagged_team, 'untagged_work': untagged_work})
-    except Exception:
-        pass
-    finally:
-        return dict_count
+def expand_tags(serie, tag_keys=None):
+    """
+    Expand a serie of tag dicts into a DataFrame with one column per tag key, in a single pass.
+    Missing and empty tags are NaN.
+    """
+    tags = pd.DataFrame.from_records([row if isinstance(row, dict) else {} for row in serie], index=serie.index)
+    if tag_keys is not None:
+        tags = tags.reindex(columns=list(tag_keys))
+    return tags.replace('', np.nan)
+
+
+class ConcurrencyLimiter(object):
+    """
+    Bounded semaphores per (service, region) to cap how many scan workers use the same AWS service
+    (or region) at the same time. Services without a configured limit are not capped.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = limits or {}
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def __get_semaphore(self, service, region):
+        if not self.limits.get(service):
+            return None
+        with self.lock:
+            key = (service, region)
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.BoundedSemaphore(int(self.limits[service]))
+            return self.semaphores[key]
+
+    @contextmanager
+    def limit(self, service, region=None):
+        semaphore = self.__get_semaphore(service, region)
+        if semaphore is None:
+            yield
+        else:
+            with semaphore:
+                yield